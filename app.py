@@ -2,6 +2,7 @@
 """
     Main file to run the API
 """
+from contextlib import asynccontextmanager
 from functools import wraps
 import secrets
 import traceback
@@ -12,35 +13,66 @@ from typing import Annotated, Any
 
 import requests
 import uvicorn
-from fastapi import Depends, FastAPI, HTTPException, Request, status
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, status
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.templating import Jinja2Templates
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from routers import security_router
 from entities.base import (
     Config,
+    PagedResult,
     Result,
     SharedLinks,
     CacheParameters,
+    Entities,
     SearchTerm,
     Task,
     TaskGroup,
     ConfigSharedLinks,
 )
 from services import sfg20 as sv_sfg20
+from services import sfg20_client
+from services import api_keys
 from services import cache
+from services import jobs
+from services import metrics
+from services import query_stats
+from services import rate_limit
+from services import sync
 from libs import config
+from libs import timing
+from libs.responses import FastJSONResponse, RawJSON
 from libs.utils import decode, encode
 
 # from entities.template import Template, Report, Task, Tables
 # from services import dataverse as sv_dataverse
 
 
-app = FastAPI(title="IoFMT REST API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    api_keys.start_listener()
+    sync.start_refresher()
+    jobs.start_workers(config.JOBS_API_WORKERS)
+    yield
+    await jobs.stop_workers()
+    await sync.stop_refresher()
+    await api_keys.stop_listener()
+    await sfg20_client.close_clients()
+    sv_sfg20.close_pool()
+
+
+app = FastAPI(title="IoFMT REST API", lifespan=lifespan)
+NDJSON = "application/x-ndjson"
 security = HTTPBasic()
 templates = Jinja2Templates(directory="static")
 
@@ -61,9 +93,36 @@ app.add_middleware(
 @app.middleware("http")
 async def time_call(request: Request, call_next):
     start_time = time()
-    response = await call_next(request)
-    process_time = time()
+    status_code = 500
+    stats, token = query_stats.start(f"{request.method} {request.url.path}")
+    timings, timing_token = timing.start()
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        timing.stop(timing_token)
+        query_stats.stop(token)
+        process_time = time()
+        # Label by route template (/jobs/{id}), not by path
+        route = request.scope.get("route")
+        route = route.path if route is not None else "unmatched"
+        metrics.REQUEST_LATENCY.labels(request.method, route, str(status_code)).observe(
+            process_time - start_time
+        )
+
+    timings["db"] = stats["seconds"]
+    timings["total"] = process_time - start_time
     response.headers["X-Process-Time"] = str(process_time - start_time)
+    response.headers["Server-Timing"] = timing.server_timing(timings)
+    if timing.sampled():
+        timing.log(request.method, route, status_code, timings)
+    # Statements run by the request, for the master key only. A streamed
+    # response runs its statements after the headers are sent
+    if security_router.is_master_key(
+        request.headers.get(security_router.API_KEY_NAME, "")
+    ):
+        response.headers["X-DB-Queries"] = str(stats["queries"])
+        response.headers["X-DB-Time"] = str(stats["seconds"])
     return response
 
 
@@ -72,21 +131,25 @@ def rate_limited(max_calls: int, time_frame: int):
     :param max_calls: Maximum number of calls allowed in the specified time frame.
     :param time_frame: The time frame (in seconds) for which the limit applies.
     :return: Decorator function.
+
+    The limit applies to each API key (or admin user) on each endpoint and is
+    shared by all the workers, see services/rate_limit.py
     """
 
     def decorator(func):
-        calls = []
-
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            now = time()
-            calls_in_time_frame = [call for call in calls if call > now - time_frame]
-            if len(calls_in_time_frame) >= max_calls:
+            caller = kwargs.get("api_key") or kwargs.get("username") or "anonymous"
+            allowed, retry_after = await rate_limit.acquire(
+                f"{func.__name__}:{caller}", max_calls, time_frame
+            )
+            if not allowed:
+                metrics.RATE_LIMITED.labels(func.__name__).inc()
                 raise HTTPException(
                     status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                     detail="Rate limit exceeded.",
+                    headers={"Retry-After": str(retry_after)},
                 )
-            calls.append(now)
             return await func(*args, **kwargs)
 
         return wrapper
@@ -147,6 +210,28 @@ def get_current_username(
 app.openapi = custom_openapi
 
 
+def paged_response(status: str, message: str, data: list, nextLink: str | None):
+    """
+    Body of a PagedResult serialised with orjson. Returning the response
+    bypasses the validation of tens of thousands of entities against the
+    response_model, which still documents the endpoint in the OpenAPI schema.
+    data may be the RawJSON rows of the cache, copied into the body as is
+    """
+    content = {"status": status, "message": message, "data": data}
+    if nextLink is not None:
+        content["nextLink"] = nextLink
+    return FastJSONResponse(content)
+
+
+def next_link(request: Request, params: CacheParameters, cursor: str | None):
+    """URL of GET /cache that returns the page after the current one"""
+    if cursor is None:
+        return None
+    query = params.model_dump(mode="json", exclude_none=True)
+    query["cursor"] = cursor
+    return str(request.url_for("get_from_cache_page").include_query_params(**query))
+
+
 # -------------------------------------------------
 # Endpoints
 # -------------------------------------------------
@@ -174,55 +259,183 @@ async def admin(
     )
 
 
+@app.get("/admin/pool", tags=["Basic"], include_in_schema=False)
+async def admin_pool(username: Annotated[str, Depends(get_current_username)]) -> Any:
+    return {
+        "status": "OK",
+        "message": "Connection pool of the cache database in this worker",
+        "data": [await cache.get_pool_status()],
+    }
+
+
+@app.get("/metrics", tags=["Basic"], include_in_schema=False)
+async def get_metrics(username: Annotated[str, Depends(get_current_username)]) -> Any:
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+
 # -------------------------------------------------
 # SFG20 endpoints
 # -------------------------------------------------
 @app.post(
     "/schedules",
     tags=["SFG20"],
-    response_model=Result,
-    description="Search SFG20 schedules according to the parameters provided and load into the cache",
+    response_model=PagedResult,
+    response_model_exclude_none=True,
+    description="Search SFG20 schedules according to the parameters provided and load into the cache. With changes_since, only the schedules changed since that date are returned, on every page",
     operation_id="get_schedules",
+    openapi_extra={"x-ms-pageable": {"nextLinkName": "nextLink"}},
+    responses={
+        202: {
+            "model": Result,
+            "description": "With Prefer: respond-async, when SFG20 must be called, the sync is queued as a job. Poll the Location header (GET /jobs/{id})",
+        }
+    },
 )
 @rate_limited(config.THROTTLE_RATE_EXT, config.THROTTLE_TIME)
 async def get_schedules(
+    request: Request,
     search: SearchTerm,
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
+    prefer: Annotated[str | None, Header()] = None,
 ) -> Any:
     status = "OK"
     message = "No Data retrieved successfully from SFG20. No data cached."
     responses = []
+    nextLink = None
     try:
-        environment = cache.get_environment(api_key)
-        raw_data = sv_sfg20.retrieve_all_data(search, environment)
-
-        response = []
+        environment = await api_keys.get_environment(api_key)
+        params = CacheParameters(
+            user_id=search.user_id,
+            sharelink_id=search.sharelink_id,
+            type=Entities.schedules,
+            order_field=search.order_field,
+            order_direction=search.order_direction,
+            limit=search.limit,
+            cursor=search.cursor,
+        )
 
-        for item in raw_data:
-            cache.save_cache(item)
-            response.append(item["schedule"][0])
-
-        responses = response
-        if len(response) > 0:
-            if search.order_field is not None:
-                if (
-                    search.order_direction is not None
-                    and search.order_direction == "desc"
-                ):
-                    responses = sorted(
-                        response, key=lambda x: x[search.order_field], reverse=True
-                    )
-                else:
-                    responses = sorted(response, key=lambda x: x[search.order_field])
-            message = "Data retrieved successfully from SFG20 and cached in the API"
+        # Following pages are served from the cache loaded by the first one
+        count, served = 0, "fresh"
+        if search.cursor is None and "respond-async" in (prefer or ""):
+            if await sync.needs_fetch(search, db):
+                job = await jobs.enqueue(search, environment, api_key, db)
+                return job_response(request, job)
+        if search.cursor is None:
+            count, served = await sync.revalidate(search, environment, api_key, db)
+        # The delta of changes_since is merged into the cache, the answer
+        # only holds the schedules of that delta
+        flight = None
+        if search.changes_since is not None:
+            flight = sync.flight_key(search, environment)
+        with timing.phase("read"):
+            rows, next_cursor = await cache.list_cache_page(
+                params, db, raw=True, flight=flight
+            )
+        responses = RawJSON(rows)
+
+        nextLink = next_link(request, params, next_cursor)
+        if len(responses) > 0:
+            if served == "synced":
+                message = f"{count} schedules retrieved successfully from SFG20 and merged in the API cache"
+            elif served == "stale":
+                message = "Schedules retrieved from the API cache, a refresh from SFG20 is in progress"
+            else:
+                message = "Schedules retrieved from the API cache"
     except Exception as e:
         status = "Error"
         message = "Error retrieving data from SFG20"
         responses = [{"error": str(e)}]
         print(traceback.format_exc())
-    return {"status": status, "message": message, "data": responses}
+    with timing.phase("encode"):
+        return paged_response(status, message, responses, nextLink)
+
+
+@app.get(
+    "/jobs/{id}",
+    tags=["SFG20"],
+    response_model=Result,
+    description="Progress and result of an asynchronous sync job. Answers 202 Accepted while the job is queued or running",
+    operation_id="get_job",
+    responses={202: {"model": Result, "description": "The job is not finished"}},
+)
+@rate_limited(config.THROTTLE_RATE, config.THROTTLE_TIME)
+async def get_job(
+    request: Request,
+    id: str,
+    api_key: security_router.APIKey = security_router.Depends(
+        security_router.get_api_key
+    ),
+    db: AsyncSession = Depends(cache.get_session),
+) -> Any:
+    job = await jobs.get_job(id, db)
+    if job is None or (
+        job["api_key"] != api_key and not security_router.is_master_key(api_key)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Job not found"
+        )
+    return job_response(request, job)
+
+
+def job_response(request: Request, job: dict):
+    """
+    202 Accepted with the Location to poll while the job is pending, 200 OK
+    once it is finished, with the link to its schedules in the cache
+    """
+    search = job["search"]
+    data = {
+        "id": job["id"],
+        "status": job["status"],
+        "schedules": job["schedules"],
+        "attempts": job["attempts"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+    if job["status"] in ("queued", "running"):
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content={
+                "status": "OK",
+                "message": f"The sync job is {job['status']}",
+                "data": [data],
+            },
+            headers={
+                "Location": str(request.url_for("get_job", id=job["id"])),
+                "Retry-After": str(config.JOBS_POLL_INTERVAL),
+            },
+        )
+
+    if job["status"] == "done":
+        params = CacheParameters(
+            user_id=search["user_id"],
+            sharelink_id=search["sharelink_id"],
+            type=Entities.schedules,
+            order_field=search.get("order_field"),
+            order_direction=search.get("order_direction"),
+            limit=search.get("limit"),
+        )
+        query = params.model_dump(mode="json", exclude_none=True)
+        data["link"] = str(
+            request.url_for("get_from_cache_page").include_query_params(**query)
+        )
+        return {
+            "status": "OK",
+            "message": f"{job['schedules']} schedules retrieved successfully from SFG20 and merged in the API cache",
+            "data": [data],
+        }
+
+    return {
+        "status": "Error",
+        "message": "Error retrieving data from SFG20",
+        "data": [data],
+    }
 
 
 @app.post(
@@ -238,17 +451,15 @@ async def get_shared_links(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ) -> Any:
-    environment = cache.get_environment(api_key)
-    raw_response = sv_sfg20.load_shared_links(item, api_key, environment)
+    environment = await api_keys.get_environment(api_key)
+    raw_response = await sv_sfg20.load_shared_links(item, api_key, environment)
+    await cache.upsert_shared_links(
+        str(api_key), [SharedLinks(**response) for response in raw_response], db
+    )
     data = []
     for response in raw_response:
-        share = SharedLinks(**response)
-        if not cache.exists_shared_link(str(api_key), response["id"]):
-            cache.add_shared_links(share)
-        else:
-            cache.update_shared_links(share)
-
         data.append(
             {
                 "id": response["id"],
@@ -281,8 +492,8 @@ async def complete_task(
     status = "OK"
     message = "Task marked as completed in SFG20"
     try:
-        environment = cache.get_environment(api_key)
-        resp = sv_sfg20.complete_task(task, environment)
+        environment = await api_keys.get_environment(api_key)
+        resp = await sv_sfg20.complete_task(task, environment)
         response = [resp]
     except Exception as e:
         status = "Error"
@@ -309,8 +520,8 @@ async def complete_task_group(
     status = "OK"
     message = "Task marked as completed in SFG20"
     try:
-        environment = cache.get_environment(api_key)
-        resp = sv_sfg20.complete_task_group(task, environment)
+        environment = await api_keys.get_environment(api_key)
+        resp = await sv_sfg20.complete_task_group(task, environment)
         response = [resp]
     except Exception as e:
         status = "Error"
@@ -326,26 +537,73 @@ async def complete_task_group(
 @app.post(
     "/cache",
     tags=["Cache"],
-    response_model=Result,
+    response_model=PagedResult,
+    response_model_exclude_none=True,
     description="List the data in the cache according to the parameters provided. When a parameter is ",
     operation_id="get_from_cache",
+    openapi_extra={"x-ms-pageable": {"nextLinkName": "nextLink"}},
+    responses={
+        200: {
+            "content": {
+                NDJSON: {"schema": {"type": "string"}},
+            },
+            "description": "One JSON entity per line when the request accepts application/x-ndjson",
+        }
+    },
 )
 @rate_limited(config.THROTTLE_RATE, config.THROTTLE_TIME)
 async def get_from_cache(
+    request: Request,
     cacheParams: CacheParameters,
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ) -> Any:
+    return await read_cache(request, cacheParams, db)
+
+
+@app.get(
+    "/cache",
+    tags=["Cache"],
+    response_model=PagedResult,
+    response_model_exclude_none=True,
+    description="List the data in the cache using query parameters. This is the target of the nextLink of paged responses",
+    operation_id="get_from_cache_page",
+    openapi_extra={
+        "x-ms-pageable": {"nextLinkName": "nextLink"},
+        "x-ms-visibility": "internal",
+    },
+)
+@rate_limited(config.THROTTLE_RATE, config.THROTTLE_TIME)
+async def get_from_cache_page(
+    request: Request,
+    cacheParams: Annotated[CacheParameters, Query()],
+    api_key: security_router.APIKey = security_router.Depends(
+        security_router.get_api_key
+    ),
+    db: AsyncSession = Depends(cache.get_session),
+) -> Any:
+    return await read_cache(request, cacheParams, db)
+
+
+async def read_cache(request: Request, cacheParams: CacheParameters, db: AsyncSession):
     status = "OK"
     message = "Data retrieved successfully from SFG20 cache"
+    nextLink = None
     try:
-        response = cache.list_cache(cacheParams)
+        if NDJSON in request.headers.get("accept", ""):
+            return StreamingResponse(cache.stream_cache(cacheParams), media_type=NDJSON)
+        with timing.phase("read"):
+            rows, next_cursor = await cache.list_cache_page(cacheParams, db, raw=True)
+        response = RawJSON(rows)
+        nextLink = next_link(request, cacheParams, next_cursor)
     except Exception as e:
         status = "Error"
         message = "Error retrieving data from SFG20 cache"
         response = [{"error": str(e)}]
-    return {"status": status, "message": message, "data": response}
+    with timing.phase("encode"):
+        return paged_response(status, message, response, nextLink)
 
 
 @app.delete(
@@ -361,12 +619,13 @@ async def delete_from_cache(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ) -> Any:
     status = "OK"
     message = f"Successfully cleaned data cache for user {user_id}"
     response = []
     try:
-        cache.clear_cache(user_id)
+        await cache.clear_cache(user_id, db)
     except Exception as e:
         status = "Error"
         message = "Error cleaning data cache"
@@ -390,11 +649,12 @@ async def config_add(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ):
     status = "OK"
     message = "Data saved successfully in Config table"
     try:
-        cache.add_config(data)
+        await cache.add_config(data, db)
         response = []
     except Exception as e:
         status = "Error"
@@ -416,12 +676,13 @@ async def config_delete(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ):
     status = "OK"
     message = "Data deleted successfully in Config table"
     response = []
     try:
-        cache.delete_config(id)
+        await cache.delete_config(id, db)
     except Exception as e:
         status = "Error"
         message = "Error deleting data in Config table"
@@ -442,11 +703,12 @@ async def config_select(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ):
     status = "OK"
     message = "Data retrieved successfully from Config table"
     try:
-        response = cache.select_config(id)
+        response = await cache.select_config(id, db)
     except Exception as e:
         status = "Error"
         message = "Error retrieving data from Config table"
@@ -466,11 +728,12 @@ async def config_select_token(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ):
     status = "OK"
     message = "Access token retrieved successfully from configuration"
     try:
-        raw_response = cache.select_config(str(api_key))
+        raw_response = await cache.select_config(str(api_key), db)
         response = [{"access_token": raw_response[0]["access_token"]}]
     except Exception as e:
         status = "Error"
@@ -494,11 +757,12 @@ async def config_shared_links(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ) -> Any:
     status = "OK"
     message = "Data retrieved successfully from Shared_Links table"
     try:
-        response = cache.select_shared_links(str(api_key))
+        response = await cache.select_shared_links(str(api_key), db)
     except Exception as e:
         status = "Error"
         message = "Error retrieving data from Shared_Links table"
@@ -519,12 +783,13 @@ async def delete_shared_link(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ):
     status = "OK"
     message = "Data deleted successfully in Shared_Links table"
     response = []
     try:
-        cache.delete_shared_links(str(api_key), id)
+        await cache.delete_shared_links(str(api_key), id, db)
     except Exception as e:
         status = "Error"
         message = "Error deleting data in Shared_Links table"
@@ -545,11 +810,12 @@ async def add_shared_link(
     api_key: security_router.APIKey = security_router.Depends(
         security_router.get_api_key
     ),
+    db: AsyncSession = Depends(cache.get_session),
 ):
     status = "OK"
     message = "Data saved successfully in Shared_Links table"
     try:
-        cache.add_shared_links(data)
+        await cache.add_shared_links(data, db)
         response = []
     except Exception as e:
         status = "Error"
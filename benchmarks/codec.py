@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the storage codec of the cache (CACHE_CODEC): stored size of the
+rows, write throughput of save_cache_bulk and read latency of list_cache_page
+for plain JSONB, zstd without dictionary and zstd with a dictionary trained on
+the regime. Each codec runs in a transaction that is rolled back, so nothing
+is left in the cache database.
+
+    python -m benchmarks.codec --schedules 200 --tasks 50
+"""
+
+import asyncio
+import json
+from statistics import median
+from time import perf_counter
+
+import typer
+import zstandard
+from sqlalchemy import text
+
+from benchmarks.regime import make_schedule
+from entities.base import CacheParameters
+from libs import config
+from services import cache
+from services import codec
+from services import sfg20
+
+# Instantiate the typer library
+app = typer.Typer()
+
+USER = "benchmark-codec"
+LINK = "benchmark-codec"
+# Id of the dictionary of the benchmark, only known to this process
+DICT_ID = -1
+
+
+async def run(parsed, dict_id, rounds):
+    async def latest_dictionary(db):
+        return dict_id
+
+    cache.latest_dictionary = latest_dictionary
+    async with cache.session_scope() as db:
+        start = perf_counter()
+        for index in range(0, len(parsed), 20):
+            await cache.save_cache_bulk(parsed[index : index + 20], db)
+        write = perf_counter() - start
+
+        stmt = text(
+            "SELECT sum(pg_column_size(data)) + sum(coalesce(pg_column_size(payload), 0)) "
+            "FROM sfg20_data WHERE user_id = :p1"
+        )
+        size = (await db.execute(stmt.bindparams(p1=USER))).scalar()
+
+        reads = {}
+        for name, limit in (("page", 100), ("all", None)):
+            item = CacheParameters(
+                user_id=USER, sharelink_id=LINK, type="tasks", limit=limit
+            )
+            timings = []
+            for i in range(rounds):
+                start = perf_counter()
+                await cache.list_cache_page(item, db, raw=True)
+                timings.append(perf_counter() - start)
+            reads[name] = median(timings)
+
+        await db.rollback()
+    return write, size, reads
+
+
+@app.command()
+def main(schedules: int = 200, tasks: int = 50, rounds: int = 5, seed: int = 1):
+    regime = [
+        make_schedule(index, tasks=tasks, seed=seed) for index in range(schedules)
+    ]
+    parsed = [sfg20.parse_schedule(raw_data, USER, LINK) for raw_data in regime]
+    rows = sum([len(data[key]) for data in parsed for key in data])
+    size = sum(
+        [len(json.dumps(row)) for data in parsed for key in data for row in data[key]]
+    )
+    print(f"{rows} rows, {size / 1e6:.1f} MB of JSON, {config.CACHE_WRITE_MODE} writes")
+
+    fields = config.CACHE_CODEC_FIELDS["tasks"]
+    samples = [
+        json.dumps({key: task[key] for key in fields}).encode()
+        for data in parsed
+        for task in data["tasks"]
+    ]
+    codec.add_dictionary(
+        DICT_ID, zstandard.train_dictionary(112640, samples).as_bytes()
+    )
+
+    print(
+        f"{'codec':>10} {'stored MB':>10} {'rows/s':>10} {'page ms':>10} {'all ms':>10}"
+    )
+    for name, codec_name, dict_id in (
+        ("none", "none", None),
+        ("zstd", "zstd", None),
+        ("zstd+dict", "zstd", DICT_ID),
+    ):
+        config.CACHE_CODEC = codec_name
+        write, stored, reads = asyncio.run(run(parsed, dict_id, rounds))
+        print(
+            f"{name:>10} {stored / 1e6:10.2f} {rows / write:10.0f} "
+            f"{reads['page'] * 1000:10.1f} {reads['all'] * 1000:10.1f}"
+        )
+
+
+# ----------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end load test of the API. Starts the SFG20 stub (benchmarks/sfg20_stub)
+and the API under gunicorn, drives each scenario with concurrent clients and
+reports the p50/p95/p99 latency, requests per second and peak RSS of each
+gunicorn worker. The results are written as JSON, optionally compared with
+those of a previous run.
+
+The cache database is the one of the CACHE_DB_* settings, usually a local
+PostgreSQL. The benchmark API key, its shared links and its cache are removed
+at the end.
+
+    python -m benchmarks.load --workers 2 --concurrency 16 --output load.json
+    python -m benchmarks.load --baseline load.json
+"""
+
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+
+import httpx
+import typer
+
+from libs import config
+from libs.utils import decode
+
+# Instantiate the typer library
+app = typer.Typer()
+
+API_KEY = "load-test-key"
+USER = "load-test-user"
+SCENARIOS = [
+    "schedules_sync",
+    "schedules_delta",
+    "schedules",
+    "cache",
+    "shared_links",
+    "complete_task",
+    "complete_task_group",
+]
+
+
+def scenario_request(name, index, sharelink_id, changes_since=None):
+    """Method, path and body of the request number index of a scenario"""
+    if name == "schedules_sync":
+        # A new user every time: each request downloads and merges the regime
+        search = {"user_id": f"{USER}-{index}", "sharelink_id": sharelink_id}
+        return "POST", "/schedules", dict(search, access_token="load", limit=100)
+    if name == "schedules_delta":
+        # Downloads and merges the schedules changed since changes_since
+        search = {"user_id": USER, "sharelink_id": sharelink_id}
+        search.update(changes_since=changes_since, access_token="load")
+        return "POST", "/schedules", dict(search, limit=100)
+    if name == "schedules":
+        search = {"user_id": USER, "sharelink_id": sharelink_id}
+        return "POST", "/schedules", dict(search, access_token="load", limit=100)
+    if name == "cache":
+        search = {"user_id": USER, "sharelink_id": sharelink_id, "type": "tasks"}
+        return "POST", "/cache", dict(search, limit=100)
+    if name == "shared_links":
+        body = {"sharelink_id": sharelink_id, "access_token": "load"}
+        return "POST", "/shared-links", body
+    task = {
+        "sharelink_id": sharelink_id,
+        "access_token": "load",
+        "completion_date": "2024-01-01T00:00:00Z",
+    }
+    if name == "complete_task":
+        task.update(asset_id="asset-0", asset_index=0, task_id=f"task-{index}")
+        return "POST", "/task/complete", task
+    task.update(schedule_id="sch-0", visit="1", asset_id="asset-0")
+    task["tasks_completed"] = [
+        {"task_id": f"task-{item}", "duration_minutes": 5, "completion_date": "2024"}
+        for item in range(5)
+    ]
+    return "POST", "/task_group/complete", task
+
+
+def percentile(values, q):
+    """Nearest-rank percentile"""
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def worker_pids(master):
+    try:
+        with open(f"/proc/{master}/task/{master}/children") as children:
+            return [int(pid) for pid in children.read().split()]
+    except OSError:
+        return []
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+async def sample_rss(master, peaks, stop):
+    while not stop.is_set():
+        for pid in worker_pids(master):
+            peaks[pid] = max(peaks.get(pid, 0.0), rss_mb(pid))
+        try:
+            await asyncio.wait_for(stop.wait(), 0.1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def drive(client, name, requests, concurrency, sharelink_id, master, stub):
+    """Send the requests of a scenario with concurrency clients"""
+    timings = []
+    errors = [0]
+    indexes = iter(range(requests))
+
+    async def run_client():
+        for index in indexes:
+            changes_since = None
+            if name == "schedules_delta":
+                # Some schedules change before each delta sync
+                revision = await client.post(f"{stub}/revisions")
+                changes_since = revision.json()["date"]
+            method, path, body = scenario_request(
+                name, index, sharelink_id, changes_since
+            )
+            start = perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                failed = response.status_code >= 400 or (
+                    response.json().get("status") == "Error"
+                )
+            except httpx.HTTPError:
+                failed = True
+            timings.append(perf_counter() - start)
+            errors[0] += failed
+
+    peaks = {}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(master, peaks, stop))
+    start = perf_counter()
+    await asyncio.gather(*[run_client() for i in range(concurrency)])
+    elapsed = perf_counter() - start
+    stop.set()
+    await sampler
+
+    return {
+        "requests": len(timings),
+        "errors": errors[0],
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(timings) / elapsed, 1),
+        "p50_ms": round(percentile(timings, 50) * 1000, 1),
+        "p95_ms": round(percentile(timings, 95) * 1000, 1),
+        "p99_ms": round(percentile(timings, 99) * 1000, 1),
+        "max_ms": round(max(timings) * 1000, 1),
+        "peak_rss_mb": {str(pid): round(mb, 1) for pid, mb in sorted(peaks.items())},
+    }
+
+
+async def wait_ready(url, process, timeout=60):
+    async with httpx.AsyncClient() as client:
+        for i in range(timeout * 10):
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode}")
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not start in {timeout} seconds")
+
+
+async def run(settings, scenarios, master):
+    base_url = f"http://127.0.0.1:{settings['port']}"
+    stub = f"http://127.0.0.1:{settings['stub_port']}"
+    sharelink_id = f"bench-{settings['schedules']}"
+    admin = {"X-Access-Token": decode(config.GLOBAL_API_KEY)}
+    limits = httpx.Limits(max_connections=settings["concurrency"])
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=600, limits=limits
+    ) as client:
+        await client.delete(f"/config/delete/{API_KEY}", headers=admin)
+        response = await client.post(
+            "/config/add",
+            json={
+                "api_key": API_KEY,
+                "customer_name": "Load test",
+                "access_token": "load",
+                "sfg_environment": "DEMO",
+            },
+            headers=admin,
+        )
+        response.raise_for_status()
+
+        client.headers["X-Access-Token"] = API_KEY
+        results = {}
+        try:
+            # Load the cache read by the schedules and cache scenarios
+            method, path, body = scenario_request("schedules", 0, sharelink_id)
+            (await client.request(method, path, json=body)).raise_for_status()
+
+            for name in scenarios:
+                requests = settings["requests"]
+                if name in ("schedules_sync", "schedules_delta"):
+                    requests = settings["sync_requests"]
+                results[name] = await drive(
+                    client,
+                    name,
+                    requests,
+                    settings["concurrency"],
+                    sharelink_id,
+                    master,
+                    stub,
+                )
+                print_result(name, results[name])
+        finally:
+            users = [USER] + [
+                f"{USER}-{index}" for index in range(settings["sync_requests"])
+            ]
+            for user in users:
+                await client.delete("/cache", params={"user_id": user})
+            for index in range(3):
+                await client.delete(f"/config/shared_links/{sharelink_id}-{index}")
+            await client.delete(f"/config/delete/{API_KEY}", headers=admin)
+
+    return results
+
+
+def print_result(name, result):
+    peak = max(result["peak_rss_mb"].values(), default=0.0)
+    print(
+        f"{name:>20} {result['rps']:8.1f} {result['p50_ms']:9.1f} "
+        f"{result['p95_ms']:9.1f} {result['p99_ms']:9.1f} {peak:9.1f} "
+        f"{result['errors']:6d}"
+    )
+
+
+def print_comparison(results, baseline):
+    print(f"\n{'vs baseline':>20} {'rps':>8} {'p95':>9}")
+    for name, result in results.items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        rps = (result["rps"] / before["rps"] - 1) * 100 if before["rps"] else 0
+        p95 = (result["p95_ms"] / before["p95_ms"] - 1) * 100 if before["p95_ms"] else 0
+        print(f"{name:>20} {rps:+7.1f}% {p95:+8.1f}%")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@app.command()
+def main(
+    workers: int = 2,
+    concurrency: int = 16,
+    requests: int = 200,
+    sync_requests: int = 10,
+    schedules: int = 200,
+    tasks: int = 20,
+    paragraphs: int = 6,
+    duplicate_rate: float = 0.1,
+    change_rate: float = 0.05,
+    stub_latency: float = 0.05,
+    port: int = 3199,
+    stub_port: int = 3198,
+    scenario: list[str] = typer.Option(SCENARIOS, help="Scenarios to run"),
+    output: str = "load.json",
+    baseline: str = None,
+):
+    previous = None
+    if baseline is not None:
+        with open(baseline) as baseline_file:
+            previous = json.load(baseline_file)
+
+    settings = {
+        "workers": workers,
+        "concurrency": concurrency,
+        "requests": requests,
+        "sync_requests": sync_requests,
+        "schedules": schedules,
+        "tasks": tasks,
+        "paragraphs": paragraphs,
+        "duplicate_rate": duplicate_rate,
+        "change_rate": change_rate,
+        "stub_latency": stub_latency,
+        "port": port,
+        "stub_port": stub_port,
+        "cache_codec": config.CACHE_CODEC,
+        "cache_write_mode": config.CACHE_WRITE_MODE,
+    }
+    env = dict(
+        os.environ,
+        STUB_LATENCY=str(stub_latency),
+        STUB_TASKS=str(tasks),
+        STUB_PARAGRAPHS=str(paragraphs),
+        STUB_DUPLICATE_RATE=str(duplicate_rate),
+        STUB_CHANGE_RATE=str(change_rate),
+        DEMO_SFG20_URL=f"http://127.0.0.1:{stub_port}/graphql",
+        # Measure the API, not the rate limiter or the background refresher
+        THROTTLE_RATE="1000000000",
+        THROTTLE_RATE_EXT="1000000000",
+        SCHEDULES_REFRESH_INTERVAL="0",
+        PROMETHEUS_MULTIPROC_DIR=tempfile.mkdtemp(prefix="iofmt-load-"),
+    )
+    log = tempfile.NamedTemporaryFile(prefix="iofmt-load-", suffix=".log", delete=False)
+    stub = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.sfg20_stub:app"]
+        + ["--port", str(stub_port), "--log-level", "warning"],
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    api = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "-c", "gunicorn.conf.py"]
+        + ["--workers", str(workers), "--bind", f"127.0.0.1:{port}"]
+        + ["--max-requests", "0"],
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    print(f"API and stub output in {log.name}")
+
+    try:
+        asyncio.run(wait_ready(f"http://127.0.0.1:{stub_port}/docs", stub))
+        asyncio.run(wait_ready(f"http://127.0.0.1:{port}/", api))
+        print(
+            f"{'scenario':>20} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+            f"{'rss MB':>9} {'errors':>6}"
+        )
+        results = asyncio.run(run(settings, scenario, api.pid))
+    finally:
+        for process in (api, stub):
+            process.terminate()
+            process.wait(30)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "settings": settings,
+        "scenarios": results,
+    }
+    with open(output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Results written to {output}")
+
+    if previous is not None:
+        print_comparison(results, previous)
+
+
+# ----------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the stages of the data path, on synthetic regimes
+(benchmarks.regime): sfg20.parse_data per entity type, cache.save_cache per
+regime size, cache.list_cache with and without ordering, and utils.encode /
+decode. Run with pytest-benchmark, from the root of the project:
+
+    python -m pytest benchmarks/micro.py --benchmark-autosave
+    python -m pytest benchmarks/micro.py --benchmark-compare \
+        --benchmark-compare-fail=median:15%
+
+Besides the timings, each benchmark records the memory blocks one call leaves
+allocated (its result included) and its peak of traced memory (tracemalloc)
+in its extra_info, so they are saved with the run. They vary a little from
+run to run and are reported, not checked; print their change between two
+saved runs with:
+
+    python -m benchmarks.micro .benchmarks/<machine>/0001_<commit>.json \
+        .benchmarks/<machine>/0002_<commit>.json
+
+The save_cache and list_cache benchmarks need the cache database of the
+CACHE_DB_* settings (a local one) and remove their rows at the end.
+"""
+
+import asyncio
+import json
+import tracemalloc
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import typer
+
+from benchmarks.regime import make_schedule
+from entities.base import CacheParameters
+from libs import utils
+from services import cache
+from services import sfg20
+
+# Instantiate the typer library
+app = typer.Typer()
+
+USER = "benchmark-micro"
+LINK = "benchmark-micro"
+
+# Rows of a schedule handed to parse_data for each entity type
+ROWS = {
+    "schedules": lambda raw_data: [raw_data],
+    "skills": lambda raw_data: raw_data["skills"],
+    "tasks": lambda raw_data: raw_data["tasks"],
+    "assets": lambda raw_data: raw_data["assets"],
+    "frequencies": lambda raw_data: raw_data["frequencies"],
+    "classification": lambda raw_data: raw_data["tasks"],
+}
+
+
+def regime(schedules, tasks=20):
+    return [make_schedule(index, tasks=tasks) for index in range(schedules)]
+
+
+def parse(regime):
+    return [sfg20.parse_schedule(raw_data, USER, LINK) for raw_data in regime]
+
+
+def measure(function, setup=None):
+    """Memory blocks left allocated by one call of function and its peak in KB"""
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start, peak = tracemalloc.get_traced_memory()
+        result = function()
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum([stat.count_diff for stat in after.compare_to(before, "filename")])
+    del result
+    return {"alloc_blocks": blocks, "alloc_peak_kb": round((peak - start) / 1024)}
+
+
+@pytest.fixture
+def allocations(benchmark):
+    """Record the allocations of one call of a stage in its extra_info"""
+
+    def track(function, setup=None):
+        benchmark.extra_info.update(measure(function, setup))
+
+    return track
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def db(loop):
+    db = loop.run_until_complete(cache.get_db())
+    yield db
+    loop.run_until_complete(cache.clear_cache(USER, db))
+    loop.run_until_complete(db.close())
+    loop.run_until_complete(cache.engine.dispose())
+
+
+@pytest.fixture(scope="module")
+def loaded(loop, db):
+    """The cache of a regime of 50 schedules of 20 tasks"""
+    loop.run_until_complete(cache.clear_cache(USER, db))
+    loop.run_until_complete(cache.save_cache_bulk(parse(regime(50)), db))
+    loop.run_until_complete(db.commit())
+
+
+@pytest.mark.parametrize("type", list(ROWS))
+def test_parse_data(benchmark, allocations, type):
+    rows = [(raw_data["id"], ROWS[type](raw_data)) for raw_data in regime(50)]
+
+    def run():
+        return [sfg20.parse_data(data, USER, LINK, key, type) for key, data in rows]
+
+    benchmark(run)
+    allocations(run)
+
+
+@pytest.mark.parametrize("schedules", [10, 100])
+def test_save_cache(benchmark, allocations, loop, db, schedules):
+    parsed = parse(regime(schedules))
+
+    def clear():
+        loop.run_until_complete(cache.clear_cache(USER, db))
+
+    def run():
+        for data in parsed:
+            loop.run_until_complete(cache.save_cache(data, db))
+
+    # Every round inserts the regime in an empty cache
+    benchmark.pedantic(run, setup=clear, rounds=5)
+    allocations(run, setup=clear)
+
+
+@pytest.mark.parametrize("order_field", [None, "title"])
+def test_list_cache(benchmark, allocations, loop, db, loaded, order_field):
+    item = CacheParameters(
+        user_id=USER, sharelink_id=LINK, type="tasks", order_field=order_field
+    )
+
+    def run():
+        return loop.run_until_complete(cache.list_cache(item, db))
+
+    assert len(benchmark(run)) == 1000
+    allocations(run)
+
+
+def test_encode(benchmark, allocations):
+    benchmark(utils.encode, "iofmt-api-key-0123456789abcdef")
+    allocations(lambda: utils.encode("iofmt-api-key-0123456789abcdef"))
+
+
+def test_decode(benchmark, allocations):
+    value = utils.encode("iofmt-api-key-0123456789abcdef")
+    assert benchmark(utils.decode, value) == "iofmt-api-key-0123456789abcdef"
+    allocations(lambda: utils.decode(value))
+
+
+def load_allocations(path):
+    """Allocations of each benchmark of a run saved by pytest-benchmark"""
+    with open(path) as run_file:
+        run = json.load(run_file)
+    return {bench["fullname"]: bench["extra_info"] for bench in run["benchmarks"]}
+
+
+def change(before, after):
+    if not before or after is None:
+        return "n/a"
+    return f"{(after / before - 1) * 100:+.1f}%"
+
+
+@app.command()
+def main(baseline: str, run: str):
+    """Print the change of the allocations of each stage between two saved runs"""
+    previous = load_allocations(baseline)
+    print(f"{'benchmark':<60} {'blocks':>9} {'peak KB':>9}")
+    for name, allocated in load_allocations(run).items():
+        before = previous.get(name)
+        if before is None:
+            continue
+        blocks = change(before.get("alloc_blocks"), allocated.get("alloc_blocks"))
+        peak = change(before.get("alloc_peak_kb"), allocated.get("alloc_peak_kb"))
+        print(f"{name:<60} {blocks:>9} {peak:>9}")
+
+
+# ----------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    app()
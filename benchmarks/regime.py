@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic synthetic SFG20 regimes, shaped exactly like the answer of the
+regime query (SFG20_QUERY_001): schedules with their skills, tasks, assets and
+frequencies. The same seed and settings always give the same regime, and a
+schedule only depends on its index, so regimes of any size share their first
+schedules.
+
+Changes are modelled as revisions: revision 0 creates every schedule, each
+following revision modifies a fraction change_rate of them (new version, new
+task dates and durations). A regime is built for a list of revision dates and
+only holds the schedules modified since changes_since, as SFG20 does.
+
+    python -m benchmarks.regime --schedules 2000 --tasks 100 --output regime.json
+    python -m benchmarks.regime --revisions 3 --changes-since 2020-01-03T00:00:00Z
+"""
+
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+import typer
+
+# Instantiate the typer library
+app = typer.Typer()
+
+# Date of revision 0
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+WORDS = (
+    "inspect check clean test replace record verify isolate lubricate adjust "
+    "boiler pump valve filter belt fan motor damper sensor panel bearing seal "
+    "pressure temperature flow level vibration corrosion leakage noise damage "
+    "operation condition security alignment tension earthing insulation "
+    "manufacturer instructions competent person safe isolation readings"
+).split()
+
+# CoreSkillingID, Skilling, SkillingCode, Rate
+SKILLS = [
+    (1, "Electrician", "E", 42.5),
+    (2, "Mechanical Fitter", "MF", 40.0),
+    (3, "Plumber", "P", 38.0),
+    (4, "Fire Systems Engineer", "FS", 48.0),
+    (5, "Building Fabric Operative", "BF", 30.0),
+    (6, "Controls Engineer", "CE", 52.0),
+    (7, "Lift Engineer", "LE", 55.0),
+    (8, "Gas Safe Engineer", "GS", 50.0),
+]
+
+# interval, period
+FREQUENCIES = [
+    (1, "Weeks"),
+    (1, "Months"),
+    (3, "Months"),
+    (6, "Months"),
+    (12, "Months"),
+    (5, "Years"),
+]
+
+HOURS = {"Days": 24, "Weeks": 168, "Months": 730, "Years": 8760}
+
+CLASSIFICATIONS = ["Red", "Pink", "Amber", "Green"]
+
+PLACES = ["Plant room", "Roof", "Basement", "Riser", "Each floor", None]
+
+
+def sentence(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(6, 16))).capitalize() + "."
+
+
+def paragraph(rng):
+    return " ".join([sentence(rng) for i in range(rng.randint(1, 4))])
+
+
+def around(rng, mean):
+    """A count of mean on average, between half and one and a half times it"""
+    return rng.randint(max(1, mean - mean // 2), mean + mean // 2) if mean else 0
+
+
+def make_task(rng, schedule, task, skill, paragraphs, steps):
+    interval, period = rng.choice(FREQUENCIES)
+    texts = [paragraph(rng) for i in range(around(rng, paragraphs))]
+    return {
+        "_status": "active",
+        "id": f"{schedule['id']}.t.{task}.{task % 4}",
+        "date": None,
+        "title": sentence(rng)[:-1],
+        "classification": rng.choices(CLASSIFICATIONS, weights=[1, 2, 4, 8])[0],
+        "intervalInHours": interval * HOURS[period],
+        "where": rng.choice(PLACES),
+        "minutes": None,
+        "url": f"https://sfg20.example/schedules/{schedule['code']}/tasks/{task}",
+        "linkId": f"{schedule['code']}-{task}",
+        "content": texts[0] if texts else "",
+        "fullContent": "\n".join(texts),
+        "fullHtmlContent": "".join([f'<p class="sfg-text">{p}</p>' for p in texts]),
+        "steps": [
+            {"step": step + 1, "text": sentence(rng), "critical": rng.random() < 0.2}
+            for step in range(around(rng, steps))
+        ],
+        "frequency": {"interval": interval, "period": period},
+        "skill": skill,
+        "schedule": {"code": schedule["code"], "version": schedule["version"]},
+    }
+
+
+def make_schedule(
+    index,
+    version=1,
+    modified=EPOCH,
+    tasks=20,
+    assets=3,
+    duplicate_rate=0.1,
+    paragraphs=6,
+    steps=5,
+    seed=1,
+):
+    """
+    The schedule index of the regime, as modified by its version-th revision
+    on the date modified. The text of the schedule does not depend on the
+    version; the task dates and durations do. A fraction duplicate_rate of
+    the task and asset rows are repeated, as SFG20 repeats them
+    """
+    rng = random.Random(f"{seed}:{index}")
+    code = f"{index // 100 + 1:02d}-{index % 100 + 1:02d}"
+    title = sentence(rng)[:-1]
+    schedule = {
+        "id": f"sch-{index}",
+        "code": code,
+        "title": f"{code} {title}",
+        "rawTitle": title,
+        "rawWhere": rng.choice(PLACES),
+        "version": version,
+        "scheduleCategories": rng.sample(["Statutory", "Mandatory", "Optimal"], 1),
+        "retired": False,
+    }
+
+    skills = [
+        {
+            "CoreSkillingID": skill[0],
+            "Rate": skill[3],
+            "Skilling": skill[1],
+            "SkillingCode": skill[2],
+            "_id": f"{skill[0]:024x}",
+        }
+        for skill in rng.sample(SKILLS, rng.randint(1, 3))
+    ]
+    changes = random.Random(f"{seed}:{index}:{version}")
+    distinct, rows = [], []
+    for task in range(tasks):
+        row = make_task(rng, schedule, task, rng.choice(skills), paragraphs, steps)
+        row["date"] = modified.strftime("%Y-%m-%d")
+        row["minutes"] = 5 * changes.randint(1, 24)
+        distinct.append(row)
+        rows.append(row)
+        if rng.random() < duplicate_rate:
+            rows.append(dict(row))
+
+    asset_rows = []
+    for asset in range(assets):
+        row = {
+            "id": f"{schedule['id']}.a.{asset}",
+            "tag": f"{code}/{asset + 1:03d}" if rng.random() < 0.7 else None,
+            "description": f"{rng.choice(WORDS).capitalize()} {asset + 1}",
+        }
+        asset_rows.append(row)
+        if rng.random() < duplicate_rate:
+            asset_rows.append(dict(row))
+
+    frequencies = {}
+    for row in distinct:
+        label = f"{row['frequency']['interval']} {row['frequency']['period']}"
+        frequency = frequencies.setdefault(
+            label,
+            {
+                "label": label,
+                "countSchedules": 1,
+                "countTasks": 0,
+                "intervalInHours": row["intervalInHours"],
+            },
+        )
+        frequency["countTasks"] += 1
+
+    schedule["skills"] = [
+        {
+            "countTasks": sum([row["skill"] is skill for row in distinct]),
+            "skill": skill,
+        }
+        for skill in skills
+    ]
+    schedule["tasks"] = rows
+    schedule["assets"] = asset_rows
+    schedule["frequencies"] = list(frequencies.values())
+    return schedule
+
+
+def changed(index, revision, change_rate, seed=1):
+    """Whether the revision modifies the schedule index"""
+    if revision == 0:
+        return True
+    return random.Random(f"{seed}:{index}:r{revision}").random() < change_rate
+
+
+def history(index, revisions, change_rate, seed=1):
+    """Version and date of the last modification of the schedule index"""
+    version, modified = 0, None
+    for revision, date in enumerate(revisions):
+        if changed(index, revision, change_rate, seed):
+            version, modified = version + 1, date
+    return version, modified
+
+
+def parse_date(value):
+    """Date of a changesSince argument, None when empty or invalid"""
+    try:
+        date = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+def make_regime(
+    schedules,
+    sharelink_id="bench",
+    revisions=(EPOCH,),
+    changes_since=None,
+    change_rate=0.05,
+    **options,
+):
+    """
+    Answer of the regime query for a share link of schedules schedules, after
+    the revisions dated revisions. Only the schedules modified on or after
+    changes_since (a datetime) are included when it is given
+    """
+    rows = []
+    for index in range(schedules):
+        version, modified = history(
+            index, revisions, change_rate, options.get("seed", 1)
+        )
+        if changes_since is None or modified >= changes_since:
+            rows.append(make_schedule(index, version, modified, **options))
+    return {"data": {"regime": {"words": [], "guid": sharelink_id, "schedules": rows}}}
+
+
+@app.command()
+def main(
+    schedules: int = 200,
+    tasks: int = 20,
+    assets: int = 3,
+    duplicate_rate: float = 0.1,
+    paragraphs: int = 6,
+    steps: int = 5,
+    seed: int = 1,
+    revisions: int = typer.Option(0, help="Revisions after the first, one a day"),
+    change_rate: float = 0.05,
+    changes_since: str = None,
+    output: str = "regime.json",
+):
+    dates = [EPOCH + timedelta(days=revision) for revision in range(revisions + 1)]
+    regime = make_regime(
+        schedules,
+        revisions=dates,
+        changes_since=parse_date(changes_since),
+        change_rate=change_rate,
+        tasks=tasks,
+        assets=assets,
+        duplicate_rate=duplicate_rate,
+        paragraphs=paragraphs,
+        steps=steps,
+        seed=seed,
+    )
+    with open(output, "w") as output_file:
+        json.dump(regime, output_file)
+
+    rows = regime["data"]["regime"]["schedules"]
+    count = sum([len(schedule["tasks"]) for schedule in rows])
+    size = os.path.getsize(output)
+    print(f"{len(rows)} schedules, {count} tasks, {size / 1e6:.1f} MB in {output}")
+
+
+# ----------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in of the SFG20 GraphQL API for the load tests. The share link
+"bench-<n>" holds a synthetic regime (benchmarks.regime) of n schedules of
+STUB_TASKS tasks each, "bench-<n>x<t>" one of n schedules of t tasks; the
+other STUB_* settings shape the content. Every answer is delayed by
+STUB_LATENCY seconds. Mutations always succeed; the access token "invalid"
+gets a GraphQL errors answer to the regime query.
+
+The regimes honour changesSince: POST /revisions modifies a fraction
+STUB_CHANGE_RATE of the schedules of every share link, which the following
+delta syncs download again.
+
+    uvicorn benchmarks.sfg20_stub:app --port 3198
+"""
+
+import asyncio
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, Request, Response
+
+from benchmarks import regime
+
+STUB_LATENCY = float(os.environ.get("STUB_LATENCY", "0.05"))
+STUB_TASKS = int(os.environ.get("STUB_TASKS", "20"))
+STUB_OPTIONS = {
+    "assets": int(os.environ.get("STUB_ASSETS", "3")),
+    "duplicate_rate": float(os.environ.get("STUB_DUPLICATE_RATE", "0.1")),
+    "paragraphs": int(os.environ.get("STUB_PARAGRAPHS", "6")),
+    "steps": int(os.environ.get("STUB_STEPS", "5")),
+    "seed": int(os.environ.get("STUB_SEED", "1")),
+}
+STUB_CHANGE_RATE = float(os.environ.get("STUB_CHANGE_RATE", "0.05"))
+
+SHARE_LINK = re.compile(r'shareLinkI[dD]: "([^"]*)"')
+CHANGES_SINCE = re.compile(r'changesSince: "([^"]*)"')
+ACCESS_TOKEN = re.compile(r'accessToken: "([^"]*)"')
+INVALID_TOKEN = "invalid"
+ERRORS = {"errors": [{"message": "Invalid access token"}], "data": {"regime": None}}
+
+app = FastAPI(title="SFG20 stub")
+
+# Dates of the revisions, revision 0 creates the regimes
+revisions = [regime.EPOCH]
+# Share link: last revision applied and (version, date, JSON) of each schedule
+regimes = {}
+
+
+def schedules(sharelink_id):
+    """Serialised schedules of the share link, brought up to the last revision"""
+    match = re.match(r"^bench-(\d+)(?:x(\d+))?$", sharelink_id)
+    count = int(match.group(1)) if match else 1
+    tasks = int(match.group(2)) if match and match.group(2) else STUB_TASKS
+
+    state = regimes.setdefault(sharelink_id, {"revision": -1, "schedules": []})
+    for revision in range(state["revision"] + 1, len(revisions)):
+        seed = STUB_OPTIONS["seed"]
+        for index in range(count):
+            if not regime.changed(index, revision, STUB_CHANGE_RATE, seed):
+                continue
+            date = revisions[revision]
+            version = 1 if revision == 0 else state["schedules"][index][0] + 1
+            schedule = regime.make_schedule(
+                index, version, date, tasks=tasks, **STUB_OPTIONS
+            )
+            row = (version, date, json.dumps(schedule))
+            if revision == 0:
+                state["schedules"].append(row)
+            else:
+                state["schedules"][index] = row
+        state["revision"] = revision
+    return state["schedules"]
+
+
+def regime_body(sharelink_id, changes_since):
+    since = regime.parse_date(changes_since)
+    rows = [
+        body
+        for version, date, body in schedules(sharelink_id)
+        if since is None or date >= since
+    ]
+    return (
+        '{"data": {"regime": {"words": [], "guid": %s, "schedules": [%s]}}}'
+        % (json.dumps(sharelink_id), ", ".join(rows))
+    ).encode()
+
+
+@app.post("/revisions")
+async def add_revision():
+    """Modify a fraction STUB_CHANGE_RATE of the schedules of every share link"""
+    revisions.append(datetime.now(timezone.utc))
+    date = revisions[-1].strftime("%Y-%m-%dT%H:%M:%SZ")
+    return {"revision": len(revisions) - 1, "date": date}
+
+
+@app.post("/graphql")
+async def graphql(request: Request):
+    query = (await request.json())["query"]
+    match = SHARE_LINK.search(query)
+    sharelink_id = match.group(1) if match else ""
+    await asyncio.sleep(STUB_LATENCY)
+
+    match = ACCESS_TOKEN.search(query)
+    if "regime(" in query and match and match.group(1) == INVALID_TOKEN:
+        body = json.dumps(ERRORS).encode()
+    elif "regime(" in query:
+        match = CHANGES_SINCE.search(query)
+        body = regime_body(sharelink_id, match.group(1) if match else None)
+    elif "batchRegimes(" in query:
+        links = [{"shareLinkId": f"{sharelink_id}-{index}"} for index in range(3)]
+        body = json.dumps({"data": {"batchRegimes": links}}).encode()
+    elif "completeSharedTask(" in query:
+        body = json.dumps({"data": {"completeSharedTask": True}}).encode()
+    else:
+        body = json.dumps({"data": {"recordTaskCompletions": True}}).encode()
+    return Response(content=body, media_type="application/json")
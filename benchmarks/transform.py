@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of the regime transformer (services/sfg20.parse_schedule)
+against the previous implementation, which looked up the field paths of every
+row and deduplicated the records through a JSON round trip.
+
+    python -m benchmarks.transform --schedules 200 --tasks 50
+"""
+
+import json
+from timeit import repeat
+
+import typer
+
+from benchmarks.regime import make_schedule
+from libs import config
+from services import sfg20
+
+# Instantiate the typer library
+app = typer.Typer()
+
+
+def legacy_parse_data(data, user, sharelink, key, type):
+    results = []
+    for row in data:
+        record = {
+            "user_id": user,
+            "sharelink_id": sharelink,
+            "schedule_id": key,
+            "type": type,
+        }
+
+        for field in config.CACHE_DB_FIELDS[type]:
+            if "." in field:
+                field_parts = field.split(".")
+                if row[field_parts[0]] is not None:
+                    record[field_parts[1]] = row[field_parts[0]][field_parts[1]] or None
+                else:
+                    record[field_parts[1]] = None
+            else:
+                record[field] = row[field]
+
+        if type == "tasks":
+            if len(record["id"].split(".")) == 4:
+                record["task_number"] = int(record["id"].split(".")[3]) + 1
+            else:
+                record["task_number"] = 1
+        results.append(record)
+
+    results = [json.loads(x) for x in set([json.dumps(d) for d in results])]
+    return results
+
+
+def legacy_parse_schedule(raw_data, user, sharelink):
+    key = raw_data["id"]
+    return dict(
+        schedule=legacy_parse_data([raw_data], user, sharelink, key, "schedules"),
+        skills=legacy_parse_data(raw_data["skills"], user, sharelink, key, "skills"),
+        tasks=legacy_parse_data(raw_data["tasks"], user, sharelink, key, "tasks"),
+        assets=legacy_parse_data(raw_data["assets"], user, sharelink, key, "assets"),
+        frequencies=legacy_parse_data(
+            raw_data["frequencies"], user, sharelink, key, "frequencies"
+        ),
+        classifications=legacy_parse_data(
+            raw_data["tasks"], user, sharelink, key, "classification"
+        ),
+    )
+
+
+def canonical(parsed):
+    return {key: sorted(json.dumps(record) for record in parsed[key]) for key in parsed}
+
+
+@app.command()
+def main(schedules: int = 200, tasks: int = 50, rounds: int = 5):
+    regime = [make_schedule(index, tasks=tasks) for index in range(schedules)]
+
+    for raw_data in regime:
+        assert canonical(sfg20.parse_schedule(raw_data, "u", "l")) == canonical(
+            legacy_parse_schedule(raw_data, "u", "l")
+        ), "The transformers disagree"
+
+    results = {}
+    for name, parse in (
+        ("legacy", legacy_parse_schedule),
+        ("compiled", sfg20.parse_schedule),
+    ):
+        results[name] = min(
+            repeat(
+                lambda: [parse(raw_data, "u", "l") for raw_data in regime],
+                number=1,
+                repeat=rounds,
+            )
+        )
+        print(f"{name:>8}: {results[name] * 1000:8.1f} ms per regime")
+
+    print(f" speedup: {results['legacy'] / results['compiled']:8.1f}x")
+
+
+# ----------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,17 @@
+-- Baseline: the cache tables as they were created by the API before
+-- versioned migrations were introduced.
+
+CREATE TABLE IF NOT EXISTS public.sfg20_data (
+	user_id text NULL,
+	sharelink_id text NULL,
+	schedule_id text NULL,
+	"type" text NULL,
+	"data" text NULL
+);
+
+CREATE TABLE IF NOT EXISTS public.sfg20_sync (
+	user_id text NOT NULL,
+	sharelink_id text NOT NULL,
+	synced_at text NOT NULL,
+	CONSTRAINT sfg20_sync_pk PRIMARY KEY (user_id, sharelink_id)
+);
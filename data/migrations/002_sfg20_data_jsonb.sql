@@ -0,0 +1,42 @@
+-- Move the cache payload to JSONB and key every row by
+-- (user_id, sharelink_id, schedule_id, type, entity_id).
+-- entity_id is the natural id of the entity inside its schedule
+-- (see CACHE_ENTITY_KEYS in libs/config.py).
+
+DELETE FROM public.sfg20_data
+ WHERE user_id IS NULL OR sharelink_id IS NULL OR schedule_id IS NULL
+    OR "type" IS NULL OR "data" IS NULL;
+
+ALTER TABLE public.sfg20_data ALTER COLUMN "data" TYPE jsonb USING "data"::jsonb;
+
+ALTER TABLE public.sfg20_data ADD COLUMN entity_id text;
+
+UPDATE public.sfg20_data
+   SET entity_id = coalesce(CASE "type"
+                                WHEN 'skills' THEN "data" ->> 'CoreSkillingID'
+                                WHEN 'frequencies' THEN "data" ->> 'label'
+                                WHEN 'classification' THEN "data" ->> 'classification'
+                                ELSE "data" ->> 'id'
+                            END, '');
+
+DELETE FROM public.sfg20_data d
+ USING (SELECT ctid,
+               row_number() OVER (PARTITION BY user_id, sharelink_id, schedule_id, "type", entity_id
+                                  ORDER BY ctid DESC) AS rn
+          FROM public.sfg20_data) dup
+ WHERE d.ctid = dup.ctid AND dup.rn > 1;
+
+ALTER TABLE public.sfg20_data
+	ALTER COLUMN user_id SET NOT NULL,
+	ALTER COLUMN sharelink_id SET NOT NULL,
+	ALTER COLUMN schedule_id SET NOT NULL,
+	ALTER COLUMN "type" SET NOT NULL,
+	ALTER COLUMN entity_id SET NOT NULL,
+	ALTER COLUMN "data" SET NOT NULL;
+
+ALTER TABLE public.sfg20_data
+	ADD CONSTRAINT sfg20_data_pk PRIMARY KEY (user_id, sharelink_id, schedule_id, "type", entity_id);
+
+-- list_cache filters by type without a schedule; the primary key covers the
+-- other lookups (user, user + link, user + link + schedule [+ type])
+CREATE INDEX IF NOT EXISTS sfg20_data_type_idx ON public.sfg20_data (user_id, sharelink_id, "type");
@@ -0,0 +1,9 @@
+-- Sort key used to order cached entities by a text field in natural order:
+-- every run of digits is left padded so that "01-10" sorts after "01-9".
+
+CREATE OR REPLACE FUNCTION public.natural_sort_key(value text) RETURNS text
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+	SELECT coalesce(string_agg(CASE WHEN m.part[1] IS NOT NULL THEN lpad(m.part[1], 20, '0')
+	                                ELSE m.part[2] END, '' ORDER BY m.ord), '')
+	  FROM regexp_matches(coalesce(value, ''), '(\d+)|(\D+)', 'g') WITH ORDINALITY AS m(part, ord)
+$$;
@@ -0,0 +1,10 @@
+-- Token buckets of the rate limiter, shared by every gunicorn worker.
+-- One row per (endpoint, API key); losing them on a crash only resets limits.
+
+CREATE UNLOGGED TABLE IF NOT EXISTS public.rate_limits (
+	bucket text NOT NULL,
+	tokens double precision NOT NULL,
+	allowed boolean NOT NULL,
+	updated_at timestamptz NOT NULL,
+	CONSTRAINT rate_limits_pk PRIMARY KEY (bucket)
+);
@@ -0,0 +1,8 @@
+-- Freshness of the cached regime of each share link: when it was last
+-- refreshed from SFG20, and the API key whose configuration (access token and
+-- SFG20 environment) the background refresher uses.
+
+ALTER TABLE public.sfg20_sync ADD COLUMN IF NOT EXISTS api_key text;
+ALTER TABLE public.sfg20_sync ADD COLUMN IF NOT EXISTS refreshed_at timestamptz;
+
+CREATE INDEX IF NOT EXISTS sfg20_sync_refreshed_idx ON public.sfg20_sync (refreshed_at);
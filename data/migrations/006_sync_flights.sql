@@ -0,0 +1,11 @@
+-- Last completed SFG20 fetch of each single-flight key
+-- (environment, user_id, sharelink_id, changes_since). A worker that waited on
+-- the advisory lock of a key reuses the fetch finished while it was waiting.
+-- Losing the rows on a crash only costs one extra fetch.
+
+CREATE UNLOGGED TABLE IF NOT EXISTS public.sfg20_flights (
+	key text NOT NULL,
+	schedules integer NOT NULL,
+	finished_at timestamptz NOT NULL,
+	CONSTRAINT sfg20_flights_pk PRIMARY KEY (key)
+);
@@ -0,0 +1,22 @@
+-- Queue of the asynchronous /schedules syncs (Prefer: respond-async).
+-- Workers claim queued jobs with FOR UPDATE SKIP LOCKED; a running job whose
+-- heartbeat stopped is claimed again, up to a maximum number of attempts.
+
+CREATE TABLE IF NOT EXISTS public.sync_jobs (
+	id text NOT NULL,
+	api_key text NOT NULL,
+	environment text NOT NULL,
+	search jsonb NOT NULL,
+	status text NOT NULL DEFAULT 'queued',
+	schedules integer NOT NULL DEFAULT 0,
+	attempts integer NOT NULL DEFAULT 0,
+	error text NULL,
+	created_at timestamptz NOT NULL DEFAULT now(),
+	started_at timestamptz NULL,
+	heartbeat_at timestamptz NULL,
+	finished_at timestamptz NULL,
+	CONSTRAINT sync_jobs_pk PRIMARY KEY (id)
+);
+
+CREATE INDEX IF NOT EXISTS sync_jobs_pending_idx ON public.sync_jobs (created_at)
+	WHERE status IN ('queued', 'running');
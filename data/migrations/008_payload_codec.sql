@@ -0,0 +1,19 @@
+-- Compressed storage of the heavy fields of the cache (CACHE_CODEC="zstd").
+-- payload holds a zstd frame of the JSON object of the fields moved out of
+-- "data", compressed with the dictionary sfg20_codec_dicts.id = dict_id
+-- (NULL: no dictionary). Dictionaries are never updated, train_codec.py adds
+-- new ones and writes use the latest.
+
+CREATE TABLE IF NOT EXISTS public.sfg20_codec_dicts (
+	id serial NOT NULL,
+	dict bytea NOT NULL,
+	samples integer NOT NULL,
+	created_at timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT sfg20_codec_dicts_pk PRIMARY KEY (id)
+);
+
+ALTER TABLE public.sfg20_data ADD COLUMN IF NOT EXISTS payload bytea;
+ALTER TABLE public.sfg20_data ADD COLUMN IF NOT EXISTS dict_id integer;
+
+-- The payload is already compressed: store it out of line without pglz
+ALTER TABLE public.sfg20_data ALTER COLUMN payload SET STORAGE EXTERNAL;
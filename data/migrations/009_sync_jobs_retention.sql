@@ -0,0 +1,5 @@
+-- Finished sync jobs are deleted JOBS_RETENTION seconds after they finished,
+-- by the job workers while they poll.
+
+CREATE INDEX IF NOT EXISTS sync_jobs_finished_idx ON public.sync_jobs (finished_at)
+	WHERE status IN ('done', 'failed');
@@ -0,0 +1,4 @@
+-- Schedules merged by the last fetch of each single-flight key. A /schedules
+-- call with changes_since answers only these schedules, on all its pages.
+
+ALTER TABLE public.sfg20_flights ADD COLUMN IF NOT EXISTS schedule_ids text[];
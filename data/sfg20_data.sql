@@ -1,24 +1,36 @@
 /*
 
-This script creates the `sfg20_data` table in the `public` schema if it does not already exist. 
-The table includes the following columns:
-- `user_id`: Text, nullable
-- `sharelink_id`: Text, nullable
-- `schedule_id`: Text, nullable
-- `type`: Text, nullable
-- `data`: Text, nullable
+This script creates the `sfg20_data` table in the `public` schema if it does not already exist,
+as the migrations of `data/migrations` leave it (they are the reference, apply them with `python migrate.py`).
+Every row is a cached entity of a schedule:
+- `user_id`: Text, part of the primary key
+- `sharelink_id`: Text, part of the primary key
+- `schedule_id`: Text, part of the primary key
+- `type`: Text, the entity type, part of the primary key
+- `data`: JSONB, the entity (without the fields moved to `payload` when it is compressed)
+- `entity_id`: Text, the natural id of the entity inside its schedule (see CACHE_ENTITY_KEYS in libs/config.py), part of the primary key
+- `payload`: Bytea, nullable, zstd frame of the compressed fields of the entity (CACHE_CODEC="zstd")
+- `dict_id`: Integer, nullable, the `sfg20_codec_dicts` dictionary of the payload
 
 Additionally, the script sets the owner of the table to `iofmtadm` and grants all permissions on the table to `iofmtadm`.
 */
 CREATE TABLE IF NOT EXISTS public.sfg20_data (
-	user_id text NULL,
-	sharelink_id text NULL,
-	schedule_id text NULL,
-	"type" text NULL,
-	"data" text NULL
+	user_id text NOT NULL,
+	sharelink_id text NOT NULL,
+	schedule_id text NOT NULL,
+	"type" text NOT NULL,
+	"data" jsonb NOT NULL,
+	entity_id text NOT NULL,
+	payload bytea NULL,
+	dict_id integer NULL,
+	CONSTRAINT sfg20_data_pk PRIMARY KEY (user_id, sharelink_id, schedule_id, "type", entity_id)
 );
 
+ALTER TABLE public.sfg20_data ALTER COLUMN payload SET STORAGE EXTERNAL;
+
+CREATE INDEX IF NOT EXISTS sfg20_data_type_idx ON public.sfg20_data (user_id, sharelink_id, "type");
+
 -- Permissions
 
 ALTER TABLE public.sfg20_data OWNER TO iofmtadm;
-GRANT ALL ON TABLE public.sfg20_data TO iofmtadm;
\ No newline at end of file
+GRANT ALL ON TABLE public.sfg20_data TO iofmtadm;
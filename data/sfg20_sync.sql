@@ -0,0 +1,25 @@
+/*
+
+This script creates the `sfg20_sync` table in the `public` schema if it does not already exist.
+The table keeps the watermark of the last successful SFG20 sync of each share link:
+- `user_id`: Text, part of the primary key
+- `sharelink_id`: Text, part of the primary key
+- `synced_at`: Text, the ISO 8601 timestamp sent as `changesSince` in the next sync
+- `api_key`: Text, the API key whose configuration is used to refresh the share link in the background
+- `refreshed_at`: Timestamp, when the share link was last refreshed from SFG20
+
+Additionally, the script sets the owner of the table to `iofmtadm` and grants all permissions on the table to `iofmtadm`.
+*/
+CREATE TABLE IF NOT EXISTS public.sfg20_sync (
+	user_id text NOT NULL,
+	sharelink_id text NOT NULL,
+	synced_at text NOT NULL,
+	api_key text NULL,
+	refreshed_at timestamptz NULL,
+	CONSTRAINT sfg20_sync_pk PRIMARY KEY (user_id, sharelink_id)
+);
+
+-- Permissions
+
+ALTER TABLE public.sfg20_sync OWNER TO iofmtadm;
+GRANT ALL ON TABLE public.sfg20_sync TO iofmtadm;
\ No newline at end of file
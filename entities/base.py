@@ -11,6 +11,14 @@ class Result(BaseModel):
     data: list[dict] = Field(title="Data", description="The data of the request")
 
 
+class PagedResult(Result):
+    nextLink: str | None = Field(
+        None,
+        title="Next Link",
+        description="The URL of the next page of data, when there are more rows",
+    )
+
+
 class Config(BaseModel):
     api_key: str = Field(
         title="API Key",
@@ -59,6 +67,17 @@ class SearchTerm(BaseModel):
             description="The direction to order the data by",
         )
     )
+    limit: int | None = Field(
+        None,
+        ge=1,
+        title="Limit",
+        description="The maximum number of rows to return in one page",
+    )
+    cursor: str | None = Field(
+        None,
+        title="Cursor",
+        description="The opaque cursor of the page to return, taken from nextLink",
+    )
 
 
 class Entities(str, Enum):
@@ -112,6 +131,17 @@ class CacheParameters(BaseModel):
             description="The direction to order the data by",
         )
     )
+    limit: int | None = Field(
+        None,
+        ge=1,
+        title="Limit",
+        description="The maximum number of rows to return in one page",
+    )
+    cursor: str | None = Field(
+        None,
+        title="Cursor",
+        description="The opaque cursor of the page to return, taken from nextLink",
+    )
 
 
 class Task(BaseModel):
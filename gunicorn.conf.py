@@ -1,5 +1,9 @@
 # Gunicorn configuration file
 import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -10,3 +14,45 @@ bind = "0.0.0.0:3100"
 
 worker_class = "uvicorn.workers.UvicornWorker"
 workers = (multiprocessing.cpu_count() * 2) + 1
+
+# Workers write their Prometheus samples to this folder, /metrics aggregates
+# them. Set before the workers import prometheus_client
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/iofmt-metrics")
+
+# The asynchronous syncs run in a job worker process of their own (worker.py),
+# not in the HTTP workers. Set JOBS_WORKER_CONCURRENCY="0" when the job workers
+# run elsewhere
+jobs_worker = None
+
+
+def on_starting(server):
+    # Samples of a previous run of the API would be added to the new ones
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # Drop the live gauges of the worker (max_requests recycles them)
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    global jobs_worker
+
+    concurrency = os.environ.get("JOBS_WORKER_CONCURRENCY", "2")
+    if int(concurrency) > 0:
+        jobs_worker = subprocess.Popen(
+            [sys.executable, "worker.py", "--concurrency", concurrency]
+        )
+
+
+def on_exit(server):
+    # The worker finishes its running jobs; a job cut short is claimed again
+    if jobs_worker is not None:
+        jobs_worker.terminate()
+        try:
+            jobs_worker.wait(server.cfg.graceful_timeout)
+        except subprocess.TimeoutExpired:
+            jobs_worker.kill()
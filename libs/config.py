@@ -15,6 +15,7 @@ SFG20_URL = None
 THROTTLE_RATE = 100
 THROTTLE_RATE_EXT = 50
 THROTTLE_TIME = 60
+RATE_LIMIT_BACKEND = "postgres"
 
 # Load the environment variables
 load_dotenv()
@@ -35,8 +36,148 @@ if "CACHE_DB_USER" in os.environ:
 if "CACHE_DB_PWD" in os.environ:
     CACHE_DB_PWD = os.environ["CACHE_DB_PWD"]
 
+# Connection pool of each worker
+CACHE_DB_POOL_SIZE = 5
+CACHE_DB_MAX_OVERFLOW = 10
+CACHE_DB_POOL_TIMEOUT = 30
+CACHE_DB_POOL_RECYCLE = 1800
+CACHE_DB_POOL_PRE_PING = True
+# Checkouts slower than this (seconds) are counted as waits for a connection
+CACHE_DB_POOL_WAIT_THRESHOLD = 0.001
+
+if "CACHE_DB_POOL_SIZE" in os.environ:
+    CACHE_DB_POOL_SIZE = int(os.environ.get("CACHE_DB_POOL_SIZE"))
+
+if "CACHE_DB_MAX_OVERFLOW" in os.environ:
+    CACHE_DB_MAX_OVERFLOW = int(os.environ.get("CACHE_DB_MAX_OVERFLOW"))
+
+if "CACHE_DB_POOL_TIMEOUT" in os.environ:
+    CACHE_DB_POOL_TIMEOUT = float(os.environ.get("CACHE_DB_POOL_TIMEOUT"))
+
+if "CACHE_DB_POOL_RECYCLE" in os.environ:
+    CACHE_DB_POOL_RECYCLE = int(os.environ.get("CACHE_DB_POOL_RECYCLE"))
+
+if "CACHE_DB_POOL_PRE_PING" in os.environ:
+    CACHE_DB_POOL_PRE_PING = os.environ.get("CACHE_DB_POOL_PRE_PING").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+
+# Statements prepared and kept by each asyncpg connection of the pool
+CACHE_DB_STATEMENT_CACHE = 500
+
+if "CACHE_DB_STATEMENT_CACHE" in os.environ:
+    CACHE_DB_STATEMENT_CACHE = int(os.environ.get("CACHE_DB_STATEMENT_CACHE"))
+
+# Statements slower than DB_SLOW_QUERY_SECONDS are logged with the types of
+# their parameters (0 disables the log)
+DB_SLOW_QUERY_SECONDS = 0.5
+
+if "DB_SLOW_QUERY_SECONDS" in os.environ:
+    DB_SLOW_QUERY_SECONDS = float(os.environ.get("DB_SLOW_QUERY_SECONDS"))
+
+# Share of the requests whose Server-Timing phases are also logged as a JSON
+# line (0 disables the log, 1 logs every request)
+TIMING_LOG_SAMPLE = 0.01
+
+if "TIMING_LOG_SAMPLE" in os.environ:
+    TIMING_LOG_SAMPLE = float(os.environ.get("TIMING_LOG_SAMPLE"))
+
 # CACHE_DB = "data/cache.db"
 CACHE_DB = f"postgresql://{CACHE_DB_USER}:{CACHE_DB_PWD}@{CACHE_DB_HOST}/postgres"
+# The API uses asyncpg, CACHE_DB (psycopg2) is kept for the migrations
+CACHE_DB_ASYNC = (
+    f"postgresql+asyncpg://{CACHE_DB_USER}:{CACHE_DB_PWD}@{CACHE_DB_HOST}/postgres"
+)
+
+# Bulk writes of the cache: "insert" sends one multi-row INSERT per batch,
+# "copy" streams the batch with PostgreSQL COPY
+CACHE_WRITE_MODE = "insert"
+CACHE_WRITE_BATCH_ROWS = 5000
+
+if "CACHE_WRITE_MODE" in os.environ:
+    CACHE_WRITE_MODE = os.environ.get("CACHE_WRITE_MODE").lower()
+
+if "CACHE_WRITE_BATCH_ROWS" in os.environ:
+    CACHE_WRITE_BATCH_ROWS = int(os.environ.get("CACHE_WRITE_BATCH_ROWS"))
+
+# Storage of the heavy fields of the cache: "none" keeps them in
+# sfg20_data.data, "zstd" moves the CACHE_CODEC_FIELDS of each type to
+# sfg20_data.payload, compressed at CACHE_CODEC_LEVEL with the latest
+# dictionary trained by train_codec.py. Those fields can not be used as
+# order_field once compressed
+CACHE_CODEC = "none"
+CACHE_CODEC_LEVEL = 3
+CACHE_CODEC_FIELDS = {
+    "tasks": ["content", "fullContent", "fullHtmlContent", "steps"],
+}
+
+if "CACHE_CODEC" in os.environ:
+    CACHE_CODEC = os.environ.get("CACHE_CODEC").lower()
+
+if "CACHE_CODEC_LEVEL" in os.environ:
+    CACHE_CODEC_LEVEL = int(os.environ.get("CACHE_CODEC_LEVEL"))
+
+# Seconds subtracted from the start of a sync when it is stored as the
+# changesSince watermark, to cover clock skew with SFG20
+SYNC_WATERMARK_OVERLAP = 300
+
+if "SYNC_WATERMARK_OVERLAP" in os.environ:
+    SYNC_WATERMARK_OVERLAP = int(os.environ.get("SYNC_WATERMARK_OVERLAP"))
+
+# /schedules answers from the cache while the regime of the share link is
+# younger than SCHEDULES_MAX_AGE seconds. Past that age it still answers from
+# the cache and refreshes it in the background. Every
+# SCHEDULES_REFRESH_INTERVAL seconds one worker refreshes the stale share links
+# of config_shared_links (0 disables it)
+SCHEDULES_MAX_AGE = 300
+SCHEDULES_REFRESH_INTERVAL = 60
+SCHEDULES_REFRESH_LOCK_ID = 20240502
+# Class of the advisory locks that serialise identical SFG20 fetches. A worker
+# waiting for the fetch of another one retries the lock every SYNC_LOCK_POLL
+# seconds, without holding a connection in between
+SYNC_LOCK_CLASS = 20240503
+SYNC_LOCK_POLL = 0.2
+
+if "SCHEDULES_MAX_AGE" in os.environ:
+    SCHEDULES_MAX_AGE = int(os.environ.get("SCHEDULES_MAX_AGE"))
+
+if "SCHEDULES_REFRESH_INTERVAL" in os.environ:
+    SCHEDULES_REFRESH_INTERVAL = int(os.environ.get("SCHEDULES_REFRESH_INTERVAL"))
+
+if "SYNC_LOCK_POLL" in os.environ:
+    SYNC_LOCK_POLL = float(os.environ.get("SYNC_LOCK_POLL"))
+
+# Rows fetched per round trip when /cache streams NDJSON
+CACHE_STREAM_BATCH = 1000
+
+if "CACHE_STREAM_BATCH" in os.environ:
+    CACHE_STREAM_BATCH = int(os.environ.get("CACHE_STREAM_BATCH"))
+
+# Migrations of the cache database are applied when the API starts
+CACHE_AUTO_MIGRATE = True
+
+if "CACHE_AUTO_MIGRATE" in os.environ:
+    CACHE_AUTO_MIGRATE = os.environ.get("CACHE_AUTO_MIGRATE").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+
+MIGRATIONS_LOCK_ID = 20240501
+
+MIGRATIONS_SQL_LOCK = """SELECT pg_advisory_xact_lock(:p1)"""
+
+MIGRATIONS_SQL_CREATE = """CREATE TABLE IF NOT EXISTS public.schema_migrations (version INTEGER PRIMARY KEY,
+                                                                           name TEXT NOT NULL,
+                                                                           applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"""
+
+MIGRATIONS_SQL_SELECT = """SELECT version FROM public.schema_migrations"""
+
+MIGRATIONS_SQL_INSERT = (
+    """INSERT INTO public.schema_migrations (version, name) VALUES (:p1, :p2)"""
+)
 
 # "modified" on schedules
 CACHE_DB_FIELDS = {
@@ -67,29 +208,228 @@ CACHE_DB_FIELDS = {
     "classification": ["classification", "classification"],
 }
 
-CACHE_SQL_CREATE = """CREATE TABLE IF NOT EXISTS public.sfg20_data (user_id TEXT, 
-                                                            sharelink_id TEXT, 
-                                                            schedule_id TEXT, 
-                                                            type TEXT, 
-                                                            data TEXT)"""
+# Field that identifies each entity inside its schedule (sfg20_data.entity_id)
+CACHE_ENTITY_KEYS = {
+    "schedules": "id",
+    "skills": "CoreSkillingID",
+    "tasks": "id",
+    "assets": "id",
+    "frequencies": "label",
+    "classification": "classification",
+}
+
+CACHE_SQL_DELETE_STALE = """DELETE FROM public.sfg20_data d WHERE d.user_id = :p1 and d.sharelink_id = :p2 and d.schedule_id = ANY(:p3)
+                            and NOT EXISTS (SELECT 1 FROM unnest(CAST(:p4 AS text[]), CAST(:p5 AS text[]), CAST(:p6 AS text[])) AS k(schedule_id, type, entity_id)
+                                            WHERE k.schedule_id = d.schedule_id and k.type = d.type and k.entity_id = d.entity_id)"""
+
+CACHE_SQL_UPSERT_MANY = """INSERT INTO public.sfg20_data AS d (user_id, sharelink_id, schedule_id, type, entity_id, data, payload, dict_id)
+                           SELECT :p1, :p2, r.schedule_id, r.type, r.entity_id, CAST(r.data AS jsonb), r.payload, r.dict_id
+                           FROM unnest(CAST(:p3 AS text[]), CAST(:p4 AS text[]), CAST(:p5 AS text[]), CAST(:p6 AS text[]), CAST(:p7 AS bytea[]), CAST(:p8 AS integer[]))
+                                AS r(schedule_id, type, entity_id, data, payload, dict_id)
+                           ON CONFLICT (user_id, sharelink_id, schedule_id, type, entity_id)
+                           DO UPDATE SET data = EXCLUDED.data, payload = EXCLUDED.payload, dict_id = EXCLUDED.dict_id
+                           WHERE d.data IS DISTINCT FROM EXCLUDED.data or d.payload IS DISTINCT FROM EXCLUDED.payload"""
+
+CACHE_SQL_CREATE_STAGE = """CREATE TEMP TABLE IF NOT EXISTS sfg20_stage (schedule_id TEXT, type TEXT, entity_id TEXT, data TEXT, payload BYTEA, dict_id INTEGER) ON COMMIT DROP"""
+
+CACHE_SQL_TRUNCATE_STAGE = """TRUNCATE sfg20_stage"""
+
+CACHE_SQL_STAGE_TABLE = "sfg20_stage"
+
+CACHE_SQL_STAGE_COLUMNS = [
+    "schedule_id",
+    "type",
+    "entity_id",
+    "data",
+    "payload",
+    "dict_id",
+]
+
+CACHE_SQL_DELETE_STALE_STAGE = """DELETE FROM public.sfg20_data d WHERE d.user_id = :p1 and d.sharelink_id = :p2 and d.schedule_id = ANY(:p3)
+                                  and NOT EXISTS (SELECT 1 FROM sfg20_stage k
+                                                  WHERE k.schedule_id = d.schedule_id and k.type = d.type and k.entity_id = d.entity_id)"""
+
+CACHE_SQL_UPSERT_STAGE = """INSERT INTO public.sfg20_data AS d (user_id, sharelink_id, schedule_id, type, entity_id, data, payload, dict_id)
+                            SELECT :p1, :p2, schedule_id, type, entity_id, CAST(data AS jsonb), payload, dict_id FROM sfg20_stage
+                            ON CONFLICT (user_id, sharelink_id, schedule_id, type, entity_id)
+                            DO UPDATE SET data = EXCLUDED.data, payload = EXCLUDED.payload, dict_id = EXCLUDED.dict_id
+                            WHERE d.data IS DISTINCT FROM EXCLUDED.data or d.payload IS DISTINCT FROM EXCLUDED.payload"""
+
+# Expressions (and their SQL types) used to order and paginate list_cache:
+# numbers first in numeric order, then text in natural order
+CACHE_SQL_SORT_KEYS = [
+    ("CASE jsonb_typeof(data -> :p5) WHEN 'number' THEN 0 ELSE 1 END", "integer"),
+    (
+        "CASE jsonb_typeof(data -> :p5) WHEN 'number' THEN CAST(data ->> :p5 AS numeric) ELSE 0 END",
+        "numeric",
+    ),
+    ("natural_sort_key(data ->> :p5)", "text"),
+]
+
+CACHE_SQL_KEY_COLUMNS = [
+    ("schedule_id", "text"),
+    ("type", "text"),
+    ("entity_id", "text"),
+]
+
+CACHE_SQL_CLEAR = """DELETE FROM public.sfg20_data WHERE user_id = :p1"""
+
+CACHE_SQL_SELECT_LATEST_DICT = """SELECT max(id) FROM public.sfg20_codec_dicts"""
+
+CACHE_SQL_SELECT_DICTS = (
+    """SELECT id, dict FROM public.sfg20_codec_dicts WHERE id = ANY(:p1)"""
+)
+
+CACHE_SQL_INSERT_DICT = """INSERT INTO public.sfg20_codec_dicts (dict, samples) VALUES (:p1, :p2) RETURNING id"""
+
+CACHE_SQL_SAMPLE_PAYLOADS = """SELECT data, payload, dict_id FROM public.sfg20_data WHERE type = :p1 ORDER BY random() LIMIT :p2"""
+
+CACHE_SQL_SELECT_SYNC = """SELECT synced_at, extract(epoch FROM now() - refreshed_at) FROM public.sfg20_sync WHERE user_id = :p1 and sharelink_id = :p2"""
 
-CACHE_SQL_DELETE = """DELETE FROM public.sfg20_data WHERE user_id = :p1 and sharelink_id = :p2 and schedule_id = :p3"""
+CACHE_SQL_UPSERT_SYNC = """INSERT INTO public.sfg20_sync (user_id, sharelink_id, synced_at, api_key, refreshed_at) VALUES (:p1, :p2, :p3, :p4, now())
+                           ON CONFLICT (user_id, sharelink_id) DO UPDATE SET synced_at = EXCLUDED.synced_at, api_key = EXCLUDED.api_key, refreshed_at = EXCLUDED.refreshed_at"""
 
-CACHE_SQL_INSERT = """INSERT INTO public.sfg20_data (user_id, sharelink_id, schedule_id, type, data) VALUES (:p1, :p2, :p3, :p4, :p5)"""
+CACHE_SQL_SELECT_STALE_LINKS = """SELECT s.user_id, s.sharelink_id, s.api_key, c.access_token, c.sfg_environment
+                                  FROM public.sfg20_sync s
+                                  JOIN public.config_shared_links l ON l.api_key = s.api_key and l.id = s.sharelink_id
+                                  JOIN public.config c ON c.api_key = s.api_key
+                                  WHERE s.refreshed_at IS NULL or s.refreshed_at < now() - make_interval(secs => :p1)
+                                  ORDER BY s.refreshed_at NULLS FIRST"""
 
-CACHE_SQL_CLEAR = """DELETE FROM public.sfg20_data WHERE user = :p1"""
+CACHE_SQL_TRY_SESSION_LOCK = """SELECT pg_try_advisory_lock(:p1)"""
+
+CACHE_SQL_UNLOCK = """SELECT pg_advisory_unlock(:p1)"""
+
+CACHE_SQL_TRY_LOCK_FLIGHT = (
+    """SELECT pg_try_advisory_xact_lock(:p1, hashtext(:p2)), now()"""
+)
+
+CACHE_SQL_SELECT_FLIGHT = """SELECT schedules FROM public.sfg20_flights WHERE key = :p1 and finished_at >= :p2"""
+
+CACHE_SQL_SELECT_FLIGHT_SCHEDULES = """SELECT schedule_ids FROM public.sfg20_flights WHERE key = :p1"""
+
+CACHE_SQL_UPSERT_FLIGHT = """INSERT INTO public.sfg20_flights (key, schedules, schedule_ids, finished_at) VALUES (:p1, :p2, CAST(:p3 AS text[]), clock_timestamp())
+                             ON CONFLICT (key) DO UPDATE SET schedules = EXCLUDED.schedules, schedule_ids = EXCLUDED.schedule_ids,
+                                                             finished_at = EXCLUDED.finished_at"""
+
+CACHE_SQL_CLEAR_SYNC = """DELETE FROM public.sfg20_sync WHERE user_id = :p1"""
 
 CACHE_SQL_INSERT_CONFIG = """INSERT INTO public.config (api_key, customer_name, access_token, sfg_environment) VALUES (:p1, :p2, :p3, :p4)"""
 
 CACHE_SQL_DELETE_CONFIG = """DELETE FROM public.config WHERE api_key = :p1"""
 
+CACHE_SQL_NOTIFY_CONFIG = """SELECT pg_notify(:p1, :p2)"""
+
 CACHE_SQL_DELETE_SHARED_LINKS = (
     """DELETE FROM config_shared_links WHERE api_key = :p1 and id = :p2"""
 )
 
 CACHE_SQL_INSERT_SHARED_LINKS = "INSERT INTO config_shared_links (api_key, id, link_name, url) VALUES (:p1, :p2, :p3, :p4)"
 
-CACHE_SQL_UPDATE_SHARED_LINKS = "UPDATE config_shared_links SET link_name = :p3, url = :p4 WHERE api_key = :p1 AND id = :p2"
+CACHE_SQL_UPSERT_SHARED_LINKS = """INSERT INTO config_shared_links AS l (api_key, id, link_name, url)
+                                   SELECT :p1, r.id, r.link_name, r.url
+                                   FROM unnest(CAST(:p2 AS text[]), CAST(:p3 AS text[]), CAST(:p4 AS text[])) AS r(id, link_name, url)
+                                   ON CONFLICT (api_key, id) DO UPDATE SET link_name = EXCLUDED.link_name, url = EXCLUDED.url
+                                   WHERE l.link_name IS DISTINCT FROM EXCLUDED.link_name or l.url IS DISTINCT FROM EXCLUDED.url"""
+
+
+# -------------------------------------------------
+# Rate limiter
+# -------------------------------------------------
+if "RATE_LIMIT_BACKEND" in os.environ:
+    RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND").lower()
+
+# Calls allowed per THROTTLE_TIME seconds to each API key on each endpoint
+# (THROTTLE_RATE_EXT on the endpoints that call SFG20)
+if "THROTTLE_RATE" in os.environ:
+    THROTTLE_RATE = int(os.environ.get("THROTTLE_RATE"))
+
+if "THROTTLE_RATE_EXT" in os.environ:
+    THROTTLE_RATE_EXT = int(os.environ.get("THROTTLE_RATE_EXT"))
+
+if "THROTTLE_TIME" in os.environ:
+    THROTTLE_TIME = int(os.environ.get("THROTTLE_TIME"))
+
+RATE_LIMIT_SQL_ACQUIRE = """INSERT INTO public.rate_limits AS r (bucket, tokens, allowed, updated_at) VALUES (:p1, :p2 - 1, true, now())
+                            ON CONFLICT (bucket) DO UPDATE SET
+                                allowed = least(:p2, r.tokens + extract(epoch FROM now() - r.updated_at) * :p3) >= 1,
+                                tokens = least(:p2, r.tokens + extract(epoch FROM now() - r.updated_at) * :p3)
+                                         - CASE WHEN least(:p2, r.tokens + extract(epoch FROM now() - r.updated_at) * :p3) >= 1 THEN 1 ELSE 0 END,
+                                updated_at = now()
+                            RETURNING tokens, allowed"""
+
+
+# -------------------------------------------------
+# Sync jobs
+# -------------------------------------------------
+# Seconds between two polls of an idle job worker, also sent to the clients
+# as Retry-After. A running job that has not sent a heartbeat for
+# JOBS_STALE_AFTER seconds is claimed again, at most JOBS_MAX_ATTEMPTS times.
+# The jobs run in worker.py, a process of its own (gunicorn.conf.py starts one
+# next to the API with JOBS_WORKER_CONCURRENCY consumers); JOBS_API_WORKERS
+# consumers can also run inside each API worker, for development.
+# Every JOBS_MAINTENANCE_INTERVAL seconds the consumers of a process delete the
+# jobs finished JOBS_RETENTION seconds ago and fail those abandoned too often
+JOBS_POLL_INTERVAL = 5
+JOBS_HEARTBEAT = 10
+JOBS_STALE_AFTER = 60
+JOBS_MAX_ATTEMPTS = 3
+JOBS_API_WORKERS = 0
+JOBS_RETENTION = 86400
+JOBS_MAINTENANCE_INTERVAL = 60
+
+if "JOBS_POLL_INTERVAL" in os.environ:
+    JOBS_POLL_INTERVAL = int(os.environ.get("JOBS_POLL_INTERVAL"))
+
+if "JOBS_STALE_AFTER" in os.environ:
+    JOBS_STALE_AFTER = int(os.environ.get("JOBS_STALE_AFTER"))
+
+if "JOBS_MAX_ATTEMPTS" in os.environ:
+    JOBS_MAX_ATTEMPTS = int(os.environ.get("JOBS_MAX_ATTEMPTS"))
+
+if "JOBS_API_WORKERS" in os.environ:
+    JOBS_API_WORKERS = int(os.environ.get("JOBS_API_WORKERS"))
+
+if "JOBS_RETENTION" in os.environ:
+    JOBS_RETENTION = int(os.environ.get("JOBS_RETENTION"))
+
+if "JOBS_MAINTENANCE_INTERVAL" in os.environ:
+    JOBS_MAINTENANCE_INTERVAL = int(os.environ.get("JOBS_MAINTENANCE_INTERVAL"))
+
+JOBS_SQL_INSERT = """INSERT INTO public.sync_jobs (id, api_key, environment, search) VALUES (:p1, :p2, :p3, CAST(:p4 AS jsonb))"""
+
+JOBS_SQL_SELECT = """SELECT id, api_key, status, schedules, attempts, error, created_at, started_at, finished_at, search
+                     FROM public.sync_jobs WHERE id = :p1"""
+
+JOBS_SQL_CLAIM = """UPDATE public.sync_jobs SET status = 'running', attempts = attempts + 1, error = NULL,
+                                                started_at = now(), heartbeat_at = now()
+                    WHERE id = (SELECT id FROM public.sync_jobs
+                                WHERE (status = 'queued' or (status = 'running' and heartbeat_at < now() - make_interval(secs => :p1)))
+                                      and attempts < :p2
+                                ORDER BY created_at
+                                LIMIT 1
+                                FOR UPDATE SKIP LOCKED)
+                    RETURNING id, api_key, environment, search"""
+
+JOBS_SQL_HEARTBEAT = """UPDATE public.sync_jobs SET schedules = :p2, heartbeat_at = now() WHERE id = :p1 and status = 'running'"""
+
+JOBS_SQL_FINISH = """UPDATE public.sync_jobs SET status = :p2, schedules = :p3, error = :p4, finished_at = now() WHERE id = :p1"""
+
+JOBS_SQL_PURGE = """DELETE FROM public.sync_jobs WHERE status IN ('done', 'failed') and finished_at < now() - make_interval(secs => :p1)"""
+
+JOBS_SQL_ABANDON = """UPDATE public.sync_jobs SET status = 'failed', error = 'The job was abandoned by its worker', finished_at = now()
+                      WHERE status = 'running' and heartbeat_at < now() - make_interval(secs => :p1) and attempts >= :p2"""
+
+
+# -------------------------------------------------
+# API key cache
+# -------------------------------------------------
+API_KEY_CACHE_TTL = 300
+API_KEY_CHANNEL = "iofmt_api_keys"
+API_KEY_LISTEN_RETRY = 5
+
+if "API_KEY_CACHE_TTL" in os.environ:
+    API_KEY_CACHE_TTL = int(os.environ.get("API_KEY_CACHE_TTL"))
 
 
 # -------------------------------------------------
@@ -122,6 +462,50 @@ if "PROD_SFG20_URL" in os.environ:
 
 SFG20_ENVS = {"DEMO": DEMO_SFG20_URL, "PROD": PROD_SFG20_URL}
 
+# -------------------------------------------------
+# SFG20 HTTP client configuration
+# -------------------------------------------------
+SFG20_HTTP2 = False
+SFG20_MAX_CONNECTIONS = 20
+SFG20_MAX_KEEPALIVE = 10
+SFG20_KEEPALIVE_EXPIRY = 30
+SFG20_TIMEOUT = 120
+SFG20_CONNECT_TIMEOUT = 10
+
+if "SFG20_HTTP2" in os.environ:
+    SFG20_HTTP2 = os.environ.get("SFG20_HTTP2").lower() in ("1", "true", "yes")
+
+if "SFG20_MAX_CONNECTIONS" in os.environ:
+    SFG20_MAX_CONNECTIONS = int(os.environ.get("SFG20_MAX_CONNECTIONS"))
+
+if "SFG20_MAX_KEEPALIVE" in os.environ:
+    SFG20_MAX_KEEPALIVE = int(os.environ.get("SFG20_MAX_KEEPALIVE"))
+
+if "SFG20_KEEPALIVE_EXPIRY" in os.environ:
+    SFG20_KEEPALIVE_EXPIRY = float(os.environ.get("SFG20_KEEPALIVE_EXPIRY"))
+
+if "SFG20_TIMEOUT" in os.environ:
+    SFG20_TIMEOUT = float(os.environ.get("SFG20_TIMEOUT"))
+
+if "SFG20_CONNECT_TIMEOUT" in os.environ:
+    SFG20_CONNECT_TIMEOUT = float(os.environ.get("SFG20_CONNECT_TIMEOUT"))
+
+# Regimes larger than this (bytes) are parsed in a pool of worker processes,
+# one schedule per task, with at most SFG20_PARSE_IN_FLIGHT schedules queued.
+# 0 parses every regime on the event loop
+SFG20_PARSE_PROCESS_THRESHOLD = 1024 * 1024
+SFG20_PARSE_PROCESSES = 2
+SFG20_PARSE_IN_FLIGHT = 16
+
+if "SFG20_PARSE_PROCESS_THRESHOLD" in os.environ:
+    SFG20_PARSE_PROCESS_THRESHOLD = int(os.environ.get("SFG20_PARSE_PROCESS_THRESHOLD"))
+
+if "SFG20_PARSE_PROCESSES" in os.environ:
+    SFG20_PARSE_PROCESSES = int(os.environ.get("SFG20_PARSE_PROCESSES"))
+
+if "SFG20_PARSE_IN_FLIGHT" in os.environ:
+    SFG20_PARSE_IN_FLIGHT = int(os.environ.get("SFG20_PARSE_IN_FLIGHT"))
+
 SFG20_SHLS = {
     "DEMO": "https://www.demo.facilities-iq.com/app/facilities?share={0}",
     "PROD": "https://www.facilities-iq.com/app/facilities?share={0}",
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Response classes of the API"""
+
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+class RawJSON(list):
+    """
+    List of JSON texts (such as the rows of sfg20_data read as text), copied
+    into the body of a FastJSONResponse without being decoded
+    """
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response serialised with orjson. Endpoints returning it directly skip
+    the validation of their response_model, which only documents them.
+    Top level RawJSON values are spliced into the body as they are
+    """
+
+    def render(self, content: Any) -> bytes:
+        if not isinstance(content, dict) or not any(
+            isinstance(value, RawJSON) for value in content.values()
+        ):
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+        parts = []
+        for key, value in content.items():
+            if isinstance(value, RawJSON):
+                value = "[" + ",".join(value) + "]"
+                parts.append(orjson.dumps(key) + b":" + value.encode())
+            else:
+                parts.append(
+                    orjson.dumps({key: value}, option=orjson.OPT_NON_STR_KEYS)[1:-1]
+                )
+        return b"{" + b",".join(parts) + b"}"
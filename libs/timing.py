@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Phase timings of a request, reported in the Server-Timing header.
+The time_call middleware starts the collection of each request, the code
+wraps its phases in `with timing.phase("name"):` and the time of each phase
+is summed over the request. Phases may overlap (`db` counts the statements
+run during the others). The syncs run in their own context (sync.spawn), so
+only the wait for them is collected. One request in TIMING_LOG_SAMPLE is also
+logged at INFO as a JSON line.
+"""
+
+import json
+import logging
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from libs import config
+
+logger = logging.getLogger(__name__)
+
+current = ContextVar("timings", default=None)
+
+
+def start():
+    """Collect the phases of the request from now on"""
+    timings = {}
+    return timings, current.set(timings)
+
+
+def stop(token):
+    current.reset(token)
+
+
+def add(name, seconds):
+    timings = current.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add(name, perf_counter() - start)
+
+
+def server_timing(timings):
+    """Value of the Server-Timing header, durations in milliseconds"""
+    return ", ".join(
+        [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    )
+
+
+def sampled():
+    return random.random() < config.TIMING_LOG_SAMPLE
+
+
+def log(method, route, status, timings):
+    logger.info(
+        json.dumps(
+            {
+                "event": "timing",
+                "method": method,
+                "route": route,
+                "status": status,
+                "ms": {
+                    name: round(seconds * 1000, 1) for name, seconds in timings.items()
+                },
+            }
+        )
+    )
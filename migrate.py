@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+This script applies the pending migrations of the cache database.
+The API also applies them on start up unless CACHE_AUTO_MIGRATE is false.
+"""
+
+from sqlalchemy import create_engine
+import typer
+
+from libs import config
+from services import migrations
+
+# Instantiate the typer library
+app = typer.Typer()
+
+
+# define the function for the command line
+@app.command()
+def main():
+    applied = migrations.upgrade(create_engine(config.CACHE_DB))
+    if len(applied) == 0:
+        print("The cache database is up to date")
+    for version in applied:
+        print(f"Applied migration {version}")
+
+
+# ----------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    app()
@@ -8,7 +8,7 @@ from starlette.status import HTTP_403_FORBIDDEN
 
 import libs.config as config
 from libs.utils import encode
-from services import cache
+from services import api_keys
 
 API_KEY = None
 API_KEY_NAME = "X-Access-Token"
@@ -19,12 +19,15 @@ api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 api_key_cookie = APIKeyCookie(name=API_KEY_NAME, auto_error=False)
 
 
-def retrieve_api_key(api_key: str):
-    if encode(api_key) == config.GLOBAL_API_KEY:
+def is_master_key(api_key: str):
+    return encode(api_key) == config.GLOBAL_API_KEY
+
+
+async def retrieve_api_key(api_key: str):
+    if is_master_key(api_key):
         return api_key
     else:
-        results = cache.select_config(api_key)
-        return results
+        return await api_keys.lookup(api_key)
 
 
 async def get_api_key(
@@ -33,7 +36,7 @@ async def get_api_key(
     api_key_cookie: str = Security(api_key_cookie),
 ):
     if api_key_query:
-        results = retrieve_api_key(api_key_query)
+        results = await retrieve_api_key(api_key_query)
         if results:
             return api_key_query
         else:
@@ -41,7 +44,7 @@ async def get_api_key(
                 status_code=HTTP_403_FORBIDDEN, detail="Could not validate credentials"
             )
     elif api_key_header:
-        results = retrieve_api_key(api_key_header)
+        results = await retrieve_api_key(api_key_header)
         if results:
             return api_key_header
         else:
@@ -49,7 +52,7 @@ async def get_api_key(
                 status_code=HTTP_403_FORBIDDEN, detail="Could not validate credentials"
             )
     elif api_key_cookie:
-        results = retrieve_api_key(api_key_cookie)
+        results = await retrieve_api_key(api_key_cookie)
         if results:
             return api_key_cookie
         else:
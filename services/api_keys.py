@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Per-worker cache of the API keys resolved from the config table.
+Entries expire after API_KEY_CACHE_TTL seconds. config_add and config_delete
+publish the key on the API_KEY_CHANNEL PostgreSQL channel, and a listener
+task in every gunicorn worker evicts it, so changes apply immediately.
+Every eviction bumps a generation counter: a lookup whose read overlapped an
+eviction returns what it read but does not cache it, as the row may be gone.
+"""
+
+import asyncio
+import traceback
+from time import monotonic
+
+import asyncpg
+
+from libs import config
+from services import cache
+
+entries = {}
+generation = 0
+listener = None
+
+
+async def lookup(api_key):
+    """Return the config record of the API key, or None when it is unknown"""
+    now = monotonic()
+    entry = entries.get(api_key)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    started = generation
+    async with cache.session_scope() as db:
+        results = await cache.select_config(api_key, db)
+    if len(results) == 0:
+        entries.pop(api_key, None)
+        return None
+
+    if generation == started:
+        entries[api_key] = (now + config.API_KEY_CACHE_TTL, results[0])
+    return results[0]
+
+
+async def get_environment(api_key):
+    record = await lookup(api_key)
+    if record is None:
+        raise Exception("No SFG20 environment configured for this API key")
+    return record["sfg_environment"]
+
+
+def invalidate(api_key=None):
+    global generation
+
+    generation += 1
+    if api_key:
+        entries.pop(api_key, None)
+    else:
+        entries.clear()
+
+
+def on_notify(connection, pid, channel, payload):
+    invalidate(payload)
+
+
+async def listen():
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(config.CACHE_DB)
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda connection: closed.set())
+            await conn.add_listener(config.API_KEY_CHANNEL, on_notify)
+            # Anything published while we were not listening is lost
+            invalidate()
+            await closed.wait()
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            if conn is not None:
+                conn.terminate()
+        invalidate()
+        await asyncio.sleep(config.API_KEY_LISTEN_RETRY)
+
+
+def start_listener():
+    global listener
+
+    if listener is None or listener.done():
+        listener = asyncio.get_running_loop().create_task(listen())
+
+
+async def stop_listener():
+    global listener
+
+    if listener is not None:
+        listener.cancel()
+        try:
+            await listener
+        except asyncio.CancelledError:
+            pass
+        listener = None
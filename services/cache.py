@@ -1,112 +1,569 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import base64
 import json
+import os
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from time import perf_counter
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 
 from libs import config
-from entities.base import Config, CacheParameters, Entities, SharedLinks
+from services import codec
+from services import metrics
+from services import migrations
+from services import query_stats
+from entities.base import Config, CacheParameters, Entities
 
 engine = None
+engine_owner = None
+migrated_pid = None
 SessionLocal = None
 
-
-def get_db():
-    global engine, SessionLocal
+pool_stats = {"checkouts": 0, "waits": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+# Python type of the cursor values bound to each SQL type of the sort keys
+CURSOR_TYPES = {"integer": int, "numeric": Decimal, "text": str}
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Connection pool that records how long each checkout waited for a connection"""
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            record = super()._do_get()
+            metrics.POOL_CHECKED_OUT.inc()
+            return record
+        finally:
+            wait = perf_counter() - start
+            pool_stats["checkouts"] += 1
+            pool_stats["wait_seconds"] += wait
+            if wait > config.CACHE_DB_POOL_WAIT_THRESHOLD:
+                pool_stats["waits"] += 1
+            if wait > pool_stats["max_wait_seconds"]:
+                pool_stats["max_wait_seconds"] = wait
+            metrics.POOL_WAIT.observe(wait)
+
+    def _do_return_conn(self, record):
+        metrics.POOL_CHECKED_OUT.dec()
+        super()._do_return_conn(record)
+
+
+async def get_engine():
+    """
+    Create the async engine of this process. asyncpg connections belong to the
+    process and the event loop that opened them, so a process forked from the
+    one that created the engine (gunicorn with preload_app) or a new event
+    loop gets a new engine
+    """
+    global engine, engine_owner, migrated_pid, SessionLocal
+
+    owner = (os.getpid(), asyncio.get_running_loop())
+    if engine is not None and engine_owner != owner:
+        await engine.dispose(close=False)
+        engine = None
 
     if engine is None:
-        engine = create_engine(config.CACHE_DB)
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-        db1 = SessionLocal()
-        db1.execute(text(config.CACHE_SQL_CREATE))
-        db1.commit()
-        db1.close()
+        if config.CACHE_AUTO_MIGRATE and migrated_pid != os.getpid():
+            # Migration scripts hold several statements, which asyncpg can
+            # not prepare, so they run once on a psycopg2 connection
+            await asyncio.to_thread(migrate)
+            migrated_pid = os.getpid()
+
+        engine = create_async_engine(
+            config.CACHE_DB_ASYNC,
+            poolclass=TimedQueuePool,
+            pool_size=config.CACHE_DB_POOL_SIZE,
+            max_overflow=config.CACHE_DB_MAX_OVERFLOW,
+            pool_timeout=config.CACHE_DB_POOL_TIMEOUT,
+            pool_recycle=config.CACHE_DB_POOL_RECYCLE,
+            pool_pre_ping=config.CACHE_DB_POOL_PRE_PING,
+            connect_args={
+                "prepared_statement_cache_size": config.CACHE_DB_STATEMENT_CACHE
+            },
+        )
+        event.listen(
+            engine.sync_engine,
+            "before_cursor_execute",
+            query_stats.before_cursor_execute,
+        )
+        event.listen(
+            engine.sync_engine, "after_cursor_execute", query_stats.after_cursor_execute
+        )
+        metrics.POOL_CAPACITY.set(
+            config.CACHE_DB_POOL_SIZE + config.CACHE_DB_MAX_OVERFLOW
+        )
+        engine_owner = owner
+        SessionLocal = async_sessionmaker(
+            bind=engine, autoflush=False, expire_on_commit=False
+        )
 
-    db = SessionLocal()
-    return db
+    return engine
 
 
-def list_cache(item: CacheParameters):
-    db = get_db()
+def migrate():
+    sync_engine = create_engine(config.CACHE_DB)
+    try:
+        return migrations.upgrade(sync_engine)
+    finally:
+        sync_engine.dispose()
 
-    stmt = None
 
-    if item.schedule_id is not None and (
-        item.type is not None and item.type != Entities.all
-    ):
-        stmt = text(
-            "SELECT * FROM sfg20_data WHERE user_id = :p1 AND sharelink_id = :p2 AND schedule_id = :p3 AND type = :p4"
+async def get_db():
+    """Open a new session. The caller must close it, prefer session_scope"""
+    await get_engine()
+    return SessionLocal()
+
+
+@asynccontextmanager
+async def session_scope():
+    db = await get_db()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def get_session():
+    """FastAPI dependency providing a session closed at the end of the request"""
+    async with session_scope() as db:
+        yield db
+
+
+async def get_pool_status():
+    await get_engine()
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": config.CACHE_DB_MAX_OVERFLOW,
+        "checkouts": pool_stats["checkouts"],
+        "waits": pool_stats["waits"],
+        "wait_seconds": pool_stats["wait_seconds"],
+        "max_wait_seconds": pool_stats["max_wait_seconds"],
+    }
+
+
+async def list_cache(item: CacheParameters, db):
+    response, next_cursor = await list_cache_page(item, db)
+    return response
+
+
+async def list_cache_page(item: CacheParameters, db, raw=False, flight=None):
+    """
+    Return the cached entities ordered by the database and the cursor of the
+    next page (None on the last page). Without a limit every row is returned.
+    With raw the entities are their JSON text, as stored, and are not decoded.
+    With flight (a single-flight key), or the cursor of such a page, only the
+    schedules merged by the last fetch of the key are returned
+    """
+    flight = flight or cursor_flight(item)
+    schedule_ids = None
+    if flight is not None:
+        schedule_ids = await get_flight_schedules(flight, db)
+    stmt, keys = cache_query(item, raw, schedule_ids)
+    records = (await db.execute(stmt)).fetchall()
+
+    next_cursor = None
+    if item.limit is not None and len(records) > item.limit:
+        records = records[: item.limit]
+        next_cursor = encode_cursor(item, records[-1][1 : 1 + len(keys)], flight)
+
+    await load_dictionaries([record[-1] for record in records], db)
+    response = []
+    for record in records:
+        response.append(codec.decode(record[0], record[-2], record[-1], raw))
+
+    return response, next_cursor
+
+
+def stream_cache(item: CacheParameters):
+    """
+    Prepare an async generator of NDJSON chunks with the cached entities. Rows are
+    read through a server-side cursor, CACHE_STREAM_BATCH at a time, so memory
+    stays flat whatever the size of the share link
+    """
+    flight = cursor_flight(item)
+
+    async def generate():
+        async with session_scope() as db:
+            schedule_ids = None
+            if flight is not None:
+                schedule_ids = await get_flight_schedules(flight, db)
+            stmt, keys = cache_query(item, True, schedule_ids)
+            stmt = stmt.execution_options(
+                stream_results=True, yield_per=config.CACHE_STREAM_BATCH
+            )
+            remaining = item.limit
+            result = await db.stream(stmt)
+            async for partition in result.partitions():
+                if remaining is not None:
+                    partition = partition[:remaining]
+                    remaining -= len(partition)
+                await load_dictionaries([record[-1] for record in partition])
+                yield "".join(
+                    [
+                        codec.decode(record[0], record[-2], record[-1], True) + "\n"
+                        for record in partition
+                    ]
+                )
+                if remaining == 0:
+                    break
+
+    return generate()
+
+
+def cache_query(item: CacheParameters, raw=False, schedule_ids=None):
+    """
+    Build the SELECT of list_cache. Rows are ordered by the requested field
+    (numbers first, then text in natural order) and then by the primary key,
+    which gives every row a unique position for keyset pagination.
+    With raw the data column is read as JSON text. The last two columns are
+    the compressed payload and its dictionary. schedule_ids, when given,
+    restricts the rows to those schedules
+    """
+    where = ["user_id = :p1", "sharelink_id = :p2"]
+    params = {"p1": item.user_id, "p2": item.sharelink_id}
+
+    if item.schedule_id is not None:
+        where.append("schedule_id = :p3")
+        params["p3"] = item.schedule_id
+
+    if item.type is not None and item.type != Entities.all:
+        where.append("type = :p4")
+        params["p4"] = item.type.value
+
+    if schedule_ids is not None:
+        where.append("schedule_id = ANY(:p7)")
+        params["p7"] = list(schedule_ids)
+
+    keys = list(config.CACHE_SQL_KEY_COLUMNS)
+    if item.order_field is not None:
+        keys = list(config.CACHE_SQL_SORT_KEYS) + keys
+        params["p5"] = item.order_field
+
+    if item.cursor is not None:
+        values = decode_cursor(item, keys)
+        markers = []
+        for index, key in enumerate(keys):
+            markers.append(f"CAST(:c{index} AS {key[1]})")
+            params[f"c{index}"] = values[index]
+        operator = "<" if is_descending(item) else ">"
+        where.append(
+            "({0}) {1} ({2})".format(
+                ", ".join([key[0] for key in keys]), operator, ", ".join(markers)
+            )
         )
+
+    direction = "DESC" if is_descending(item) else "ASC"
+    sql = "SELECT {0}, {1}, payload, dict_id FROM sfg20_data WHERE {2} ORDER BY {3}".format(
+        "CAST(data AS text)" if raw else "data",
+        ", ".join([key[0] for key in keys]),
+        " and ".join(where),
+        ", ".join([f"{key[0]} {direction}" for key in keys]),
+    )
+
+    if item.limit is not None:
+        sql += " LIMIT :p6"
+        params["p6"] = item.limit + 1
+
+    return text(sql).bindparams(**params), keys
+
+
+def is_descending(item):
+    return item.order_direction is not None and item.order_direction.lower() == "desc"
+
+
+def encode_cursor(item, values, flight=None):
+    cursor = {
+        "o": item.order_field,
+        "d": "desc" if is_descending(item) else "asc",
+        "k": [str(value) for value in values],
+    }
+    if flight is not None:
+        cursor["f"] = flight
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def cursor_flight(item):
+    """Single-flight key of the page that gave the cursor, if any"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(item.cursor.encode())).get("f")
+    except (ValueError, AttributeError):
+        # No cursor, or one decode_cursor rejects
+        return None
+
+
+def decode_cursor(item, keys):
+    """Return the values of the cursor converted to the types of the sort keys"""
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(item.cursor.encode()))
+        direction = "desc" if is_descending(item) else "asc"
+        if cursor["o"] == item.order_field and cursor["d"] == direction:
+            if len(cursor["k"]) == len(keys):
+                return [
+                    CURSOR_TYPES[key[1]](value) for key, value in zip(keys, cursor["k"])
+                ]
+    except (ValueError, KeyError, TypeError, ArithmeticError):
+        pass
+    raise ValueError("The cursor is not valid for the requested order")
+
+
+async def save_cache(data, db):
+    await save_cache_bulk([data], db)
+    await db.commit()
+
+
+async def save_cache_bulk(schedules, db):
+    """
+    Merge the rows of several schedules of one share link into the cache.
+    New and changed rows are upserted with one multi-row statement (or a COPY
+    into a staging table), unchanged rows are left untouched and rows no
+    longer present in those schedules are deleted. The caller owns the
+    transaction
+    """
+    if len(schedules) == 0:
+        return
+
+    first = schedules[0]["schedule"][0]
+    user_id = first["user_id"]
+    sharelink_id = first["sharelink_id"]
+    schedule_ids = [data["schedule"][0]["schedule_id"] for data in schedules]
+
+    dict_id = await latest_dictionary(db) if codec.enabled() else None
+
+    rows = {}
+    for data in schedules:
+        for key in data:
+            for item in data[key]:
+                entity_id = item[config.CACHE_ENTITY_KEYS[item["type"]]]
+                entity_id = "" if entity_id is None else str(entity_id)
+                data_json, payload = codec.encode(item, dict_id)
+                rows[(item["schedule_id"], item["type"], entity_id)] = (
+                    data_json,
+                    payload,
+                    None if payload is None else dict_id,
+                )
+
+    if config.CACHE_WRITE_MODE == "copy":
+        await copy_rows(db, rows)
+
+        stmt = text(config.CACHE_SQL_DELETE_STALE_STAGE)
+        stmt = stmt.bindparams(p1=user_id, p2=sharelink_id, p3=schedule_ids)
+        await db.execute(stmt)
+
+        stmt = text(config.CACHE_SQL_UPSERT_STAGE)
+        stmt = stmt.bindparams(p1=user_id, p2=sharelink_id)
+        await db.execute(stmt)
+    else:
+        keys = list(zip(*rows.keys()))
+        values = list(zip(*rows.values()))
+
+        stmt = text(config.CACHE_SQL_DELETE_STALE)
         stmt = stmt.bindparams(
-            p1=item.user_id, p2=item.sharelink_id, p3=item.schedule_id, p4=item.type
-        )
-    elif item.schedule_id is not None and (
-        item.type is None or item.type == Entities.all
-    ):
-        stmt = text(
-            "SELECT * FROM sfg20_data WHERE user_id = :p1 and sharelink_id = :p2 and schedule_id = :p3"
+            p1=user_id,
+            p2=sharelink_id,
+            p3=schedule_ids,
+            p4=list(keys[0]),
+            p5=list(keys[1]),
+            p6=list(keys[2]),
         )
+        await db.execute(stmt)
+
+        stmt = text(config.CACHE_SQL_UPSERT_MANY)
         stmt = stmt.bindparams(
-            p1=item.user_id, p2=item.sharelink_id, p3=item.schedule_id
+            p1=user_id,
+            p2=sharelink_id,
+            p3=list(keys[0]),
+            p4=list(keys[1]),
+            p5=list(keys[2]),
+            p6=list(values[0]),
+            p7=list(values[1]),
+            p8=list(values[2]),
         )
-    else:
-        stmt = text(
-            "SELECT * FROM sfg20_data WHERE user_id = :p1 and sharelink_id = :p2"
-        )
-        stmt = stmt.bindparams(p1=item.user_id, p2=item.sharelink_id)
+        await db.execute(stmt)
+
+
+async def copy_rows(db, rows):
+    """COPY the rows into the staging table with the binary protocol of asyncpg"""
+    await db.execute(text(config.CACHE_SQL_CREATE_STAGE))
+    await db.execute(text(config.CACHE_SQL_TRUNCATE_STAGE))
+    connection = await (await db.connection()).get_raw_connection()
+    await connection.driver_connection.copy_records_to_table(
+        config.CACHE_SQL_STAGE_TABLE,
+        records=[key + values for key, values in rows.items()],
+        columns=config.CACHE_SQL_STAGE_COLUMNS,
+    )
 
-    records = db.execute(stmt).fetchall()
-    response = []
-    for record in records:
-        response.append(json.loads(record[4]))
 
-    if item.order_field is not None:
-        if item.order_direction is not None and item.order_direction == "desc":
-            response = sorted(response, key=lambda x: x[item.order_field], reverse=True)
-        else:
-            response = sorted(response, key=lambda x: x[item.order_field])
+async def latest_dictionary(db):
+    """Id of the most recent codec dictionary, loaded in this process, or None"""
+    dict_id = (await db.execute(text(config.CACHE_SQL_SELECT_LATEST_DICT))).scalar()
+    await load_dictionaries([dict_id], db)
+    return dict_id
 
-    return response
 
+async def load_dictionaries(ids, db=None):
+    """
+    Load the codec dictionaries of ids this process does not have yet. Without
+    a session one is opened, so a streaming cursor is not interrupted
+    """
+    missing = codec.missing_dictionaries(ids)
+    if len(missing) == 0:
+        return
 
-def save_cache(data):
-    db = get_db()
+    if db is None:
+        async with session_scope() as db:
+            return await load_dictionaries(missing, db)
+
+    stmt = text(config.CACHE_SQL_SELECT_DICTS)
+    stmt = stmt.bindparams(p1=missing)
+    for res in (await db.execute(stmt)).fetchall():
+        codec.add_dictionary(res[0], res[1])
 
-    stmt_delete = text(config.CACHE_SQL_DELETE)
-    stmt_delete = stmt_delete.bindparams(
-        p1=data["schedule"][0]["user_id"],
-        p2=data["schedule"][0]["sharelink_id"],
-        p3=data["schedule"][0]["schedule_id"],
-    )
-    db.execute(stmt_delete)
-
-    for key in data:
-        for item in data[key]:
-            stmt_insert = text(config.CACHE_SQL_INSERT)
-            stmt_insert = stmt_insert.bindparams(
-                p1=item["user_id"],
-                p2=item["sharelink_id"],
-                p3=item["schedule_id"],
-                p4=item["type"],
-                p5=json.dumps(item),
-            )
-            db.execute(stmt_insert)
 
-    db.commit()
+async def add_dictionary(data, samples, db):
+    stmt = text(config.CACHE_SQL_INSERT_DICT)
+    stmt = stmt.bindparams(p1=data, p2=samples)
+    dict_id = (await db.execute(stmt)).scalar()
+    await db.commit()
+    return dict_id
 
 
-def clear_cache(user_id):
-    db = get_db()
+async def sample_payloads(type, limit, db):
+    """JSON text of the codec fields of up to limit random entities of a type"""
+    stmt = text(config.CACHE_SQL_SAMPLE_PAYLOADS)
+    stmt = stmt.bindparams(p1=type, p2=limit)
+    records = (await db.execute(stmt)).fetchall()
+    await load_dictionaries([record[2] for record in records], db)
+
+    samples = []
+    fields = config.CACHE_CODEC_FIELDS[type]
+    for record in records:
+        item = codec.decode(record[0], record[1], record[2])
+        samples.append(json.dumps({key: item.get(key) for key in fields}).encode())
+    return samples
+
+
+async def clear_cache(user_id, db):
     stmt = text(config.CACHE_SQL_CLEAR)
     stmt = stmt.bindparams(p1=user_id)
-    db.execute(stmt)
+    await db.execute(stmt)
+
+    stmt = text(config.CACHE_SQL_CLEAR_SYNC)
+    stmt = stmt.bindparams(p1=user_id)
+    await db.execute(stmt)
+    await db.commit()
+
+
+async def get_sync_state(user_id, sharelink_id, db):
+    """
+    Return the changesSince watermark of the share link and the seconds since
+    it was last refreshed (None if unknown), or None when it was never synced
+    """
+    stmt = text(config.CACHE_SQL_SELECT_SYNC)
+    stmt = stmt.bindparams(p1=user_id, p2=sharelink_id)
+    result = (await db.execute(stmt)).fetchone()
+    if result is None:
+        return None
+    age = None if result[1] is None else float(result[1])
+    return result[0], age
+
+
+async def get_watermark(user_id, sharelink_id, db):
+    state = await get_sync_state(user_id, sharelink_id, db)
+    if state is None:
+        return None
+    return state[0]
+
+
+async def set_watermark(user_id, sharelink_id, synced_at, api_key, db):
+    stmt = text(config.CACHE_SQL_UPSERT_SYNC)
+    stmt = stmt.bindparams(p1=user_id, p2=sharelink_id, p3=synced_at, p4=api_key)
+    await db.execute(stmt)
+
+
+async def select_stale_links(max_age, db):
+    """Share links of config_shared_links refreshed more than max_age seconds ago"""
+    stmt = text(config.CACHE_SQL_SELECT_STALE_LINKS)
+    stmt = stmt.bindparams(p1=float(max_age))
+    result = (await db.execute(stmt)).fetchall()
+
+    results = []
+    for res in result:
+        results.append(
+            {
+                "user_id": res[0],
+                "sharelink_id": res[1],
+                "api_key": res[2],
+                "access_token": res[3],
+                "sfg_environment": res[4],
+            }
+        )
 
+    return results
 
-def add_config(data: Config):
-    db = get_db()
 
+@asynccontextmanager
+async def session_lock(lock_id):
+    """
+    Take the session-level advisory lock, without waiting, on a connection
+    of its own that stays out of any transaction. Yields whether it was
+    taken; it is released on exit
+    """
+    await get_engine()
+    async with engine.connect() as conn:
+        stmt = text(config.CACHE_SQL_TRY_SESSION_LOCK).bindparams(p1=lock_id)
+        locked = (await conn.execute(stmt)).scalar()
+        await conn.commit()
+        try:
+            yield locked
+        finally:
+            if locked:
+                stmt = text(config.CACHE_SQL_UNLOCK).bindparams(p1=lock_id)
+                await conn.execute(stmt)
+                await conn.commit()
+
+
+async def try_lock_flight(key, db):
+    """
+    Take the advisory lock of a single-flight key until commit, without
+    waiting. Returns whether it was taken and the time of the database
+    """
+    stmt = text(config.CACHE_SQL_TRY_LOCK_FLIGHT)
+    stmt = stmt.bindparams(p1=config.SYNC_LOCK_CLASS, p2=key)
+    return tuple((await db.execute(stmt)).fetchone())
+
+
+async def get_flight(key, since, db):
+    """Number of schedules of the fetch of the key that finished since, or None"""
+    stmt = text(config.CACHE_SQL_SELECT_FLIGHT)
+    stmt = stmt.bindparams(p1=key, p2=since)
+    return (await db.execute(stmt)).scalar()
+
+
+async def get_flight_schedules(key, db):
+    """IDs of the schedules merged by the last fetch of the key ([] if unknown)"""
+    stmt = text(config.CACHE_SQL_SELECT_FLIGHT_SCHEDULES)
+    stmt = stmt.bindparams(p1=key)
+    return (await db.execute(stmt)).scalar() or []
+
+
+async def set_flight(key, schedules, db, schedule_ids=None):
+    stmt = text(config.CACHE_SQL_UPSERT_FLIGHT)
+    stmt = stmt.bindparams(p1=key, p2=schedules, p3=schedule_ids)
+    await db.execute(stmt)
+
+
+async def add_config(data: Config, db):
     stmt = text(config.CACHE_SQL_INSERT_CONFIG)
     stmt = stmt.bindparams(
         p1=data.api_key,
@@ -114,21 +571,27 @@ def add_config(data: Config):
         p3=data.access_token,
         p4=data.sfg_environment,
     )
-    db.execute(stmt)
-    db.commit()
+    await db.execute(stmt)
+    await notify_config(data.api_key, db)
+    await db.commit()
 
 
-def delete_config(api_key):
-    db = get_db()
+async def delete_config(api_key, db):
     stmt = text(config.CACHE_SQL_DELETE_CONFIG)
     stmt = stmt.bindparams(p1=api_key)
-    db.execute(stmt)
-    db.commit()
+    await db.execute(stmt)
+    await notify_config(api_key, db)
+    await db.commit()
+
 
+async def notify_config(api_key, db):
+    """Tell every worker to drop the API key from its cache, on commit"""
+    stmt = text(config.CACHE_SQL_NOTIFY_CONFIG)
+    stmt = stmt.bindparams(p1=config.API_KEY_CHANNEL, p2=api_key)
+    await db.execute(stmt)
 
-def select_config(api_key):
-    db = get_db()
 
+async def select_config(api_key, db):
     stmt = None
     if api_key == "all":
         stmt = text(
@@ -140,7 +603,7 @@ def select_config(api_key):
         )
         stmt = stmt.bindparams(p1=api_key)
 
-    result = db.execute(stmt).fetchall()
+    result = (await db.execute(stmt)).fetchall()
 
     results = []
     for res in result:
@@ -156,15 +619,13 @@ def select_config(api_key):
     return results
 
 
-def select_shared_links(api_key):
-    db = get_db()
-
+async def select_shared_links(api_key, db):
     stmt = text(
         "SELECT id, link_name, url FROM config_shared_links WHERE api_key = :p1"
     )
     stmt = stmt.bindparams(p1=api_key)
 
-    result = db.execute(stmt).fetchall()
+    result = (await db.execute(stmt)).fetchall()
 
     results = []
     for res in result:
@@ -173,51 +634,35 @@ def select_shared_links(api_key):
     return results
 
 
-def delete_shared_links(api_key, id):
-    db = get_db()
-
+async def delete_shared_links(api_key, id, db):
     stmt = text(config.CACHE_SQL_DELETE_SHARED_LINKS)
     stmt = stmt.bindparams(p1=api_key, p2=id)
 
-    db.execute(stmt)
-    db.commit()
-
+    await db.execute(stmt)
+    await db.commit()
 
-def add_shared_links(data):
-    db = get_db()
 
+async def add_shared_links(data, db):
     stmt = text(config.CACHE_SQL_INSERT_SHARED_LINKS)
     stmt = stmt.bindparams(p1=data.api_key, p2=data.id, p3=data.link_name, p4=data.url)
-    db.execute(stmt)
-    db.commit()
-
-
-def update_shared_links(data: SharedLinks):
-    db = get_db()
-
-    stmt = text(config.CACHE_SQL_UPDATE_SHARED_LINKS)
-    stmt = stmt.bindparams(p1=data.api_key, p2=data.id, p3=data.link_name, p4=data.url)
-    db.execute(stmt)
-    db.commit()
-
-
-def get_environment(api_key):
-    db = get_db()
-    stmt = text(
-        "SELECT api_key, customer_name, access_token, sfg_environment FROM config WHERE api_key = :p1"
-    )
-    stmt = stmt.bindparams(p1=api_key)
-
-    result = db.execute(stmt).fetchone()
-    return result[3]
-
-
-def exists_shared_link(api_key, id):
-    db = get_db()
-
-    stmt = text(
-        "SELECT count(1) as cnt FROM config_shared_links WHERE api_key = :p1 and id = :p2"
+    await db.execute(stmt)
+    await db.commit()
+
+
+async def upsert_shared_links(api_key, links, db):
+    """
+    Add the shared links of the api key, or update their name and url, in one
+    statement. A link listed twice keeps its last values. The links are
+    written in the order of their ids, so concurrent listings do not deadlock
+    """
+    links = {link.id: link for link in links}
+    ids = sorted(links)
+    stmt = text(config.CACHE_SQL_UPSERT_SHARED_LINKS)
+    stmt = stmt.bindparams(
+        p1=api_key,
+        p2=ids,
+        p3=[links[id].link_name for id in ids],
+        p4=[links[id].url for id in ids],
     )
-    stmt = stmt.bindparams(p1=api_key, p2=id)
-    result = db.execute(stmt).fetchone()
-    return result[0] > 0
+    await db.execute(stmt)
+    await db.commit()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Storage codec of the cache payload. With CACHE_CODEC "zstd" the
+CACHE_CODEC_FIELDS of an entity (the HTML and steps of the tasks) are moved
+out of sfg20_data.data into sfg20_data.payload, a zstd frame of their JSON
+compressed with a dictionary of sfg20_codec_dicts. Dictionaries never change,
+so every process keeps those it used by id.
+"""
+
+import json
+
+import zstandard
+
+from libs import config
+
+dictionaries = {}
+compressors = {}
+decompressors = {}
+
+
+def enabled():
+    return config.CACHE_CODEC == "zstd"
+
+
+def missing_dictionaries(ids):
+    return [id for id in set(ids) if id is not None and id not in dictionaries]
+
+
+def add_dictionary(id, data):
+    dictionaries[id] = zstandard.ZstdCompressionDict(bytes(data))
+
+
+def get_compressor(dict_id):
+    key = (dict_id, config.CACHE_CODEC_LEVEL)
+    if key not in compressors:
+        compressors[key] = zstandard.ZstdCompressor(
+            level=config.CACHE_CODEC_LEVEL, dict_data=dictionaries.get(dict_id)
+        )
+    return compressors[key]
+
+
+def get_decompressor(dict_id):
+    if dict_id not in decompressors:
+        decompressors[dict_id] = zstandard.ZstdDecompressor(
+            dict_data=dictionaries.get(dict_id)
+        )
+    return decompressors[dict_id]
+
+
+def split(item):
+    """Return the item without its compressed fields, and those fields (or None)"""
+    fields = config.CACHE_CODEC_FIELDS.get(item["type"]) if enabled() else None
+    if not fields:
+        return item, None
+
+    data = {}
+    heavy = {}
+    for key, value in item.items():
+        if key in fields:
+            heavy[key] = value
+        else:
+            data[key] = value
+    return data, heavy
+
+
+def encode(item, dict_id):
+    """Return the JSON text stored in data and the payload (None if not compressed)"""
+    data, heavy = split(item)
+    if heavy is None:
+        return json.dumps(data), None
+    return json.dumps(data), get_compressor(dict_id).compress(
+        json.dumps(heavy).encode()
+    )
+
+
+def decode(data, payload, dict_id, raw=False):
+    """
+    Merge the payload back into the entity: data is a dict, or its JSON text
+    with raw, in which case the result is JSON text as well
+    """
+    if payload is None:
+        return data
+
+    heavy = get_decompressor(dict_id).decompress(payload)
+    if not raw:
+        data.update(json.loads(heavy))
+        return data
+
+    heavy = heavy.decode()
+    if heavy == "{}":
+        return data
+    if data == "{}":
+        return heavy
+    return data[:-1] + ", " + heavy[1:]
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Queue of asynchronous /schedules syncs, stored in public.sync_jobs.
+The API enqueues a job and answers 202 Accepted; job workers (worker.py, or
+JOBS_API_WORKERS tasks inside the API) claim jobs with FOR UPDATE SKIP LOCKED,
+report their progress with a heartbeat and record the result. Every
+JOBS_MAINTENANCE_INTERVAL seconds they also delete the jobs finished more than
+JOBS_RETENTION seconds ago and fail the jobs abandoned too many times.
+"""
+
+import asyncio
+import json
+import traceback
+import uuid
+from time import monotonic
+
+from sqlalchemy import text
+
+from libs import config
+from services import cache
+from services import sync
+from entities.base import SearchTerm
+
+workers = []
+maintained_at = None
+
+
+async def enqueue(search: SearchTerm, environment: str, api_key, db):
+    job_id = str(uuid.uuid4())
+    stmt = text(config.JOBS_SQL_INSERT)
+    stmt = stmt.bindparams(
+        p1=job_id,
+        p2=api_key,
+        p3=environment,
+        p4=search.model_dump_json(),
+    )
+    await db.execute(stmt)
+    await db.commit()
+    return await get_job(job_id, db)
+
+
+async def get_job(job_id, db):
+    stmt = text(config.JOBS_SQL_SELECT)
+    stmt = stmt.bindparams(p1=job_id)
+    res = (await db.execute(stmt)).fetchone()
+    if res is None:
+        return None
+
+    return {
+        "id": res[0],
+        "api_key": res[1],
+        "status": res[2],
+        "schedules": res[3],
+        "attempts": res[4],
+        "error": res[5],
+        "created_at": res[6].isoformat(),
+        "started_at": None if res[7] is None else res[7].isoformat(),
+        "finished_at": None if res[8] is None else res[8].isoformat(),
+        "search": res[9],
+    }
+
+
+async def maintain(db):
+    """Delete the old finished jobs and fail those abandoned too many times"""
+    stmt = text(config.JOBS_SQL_PURGE)
+    stmt = stmt.bindparams(p1=float(config.JOBS_RETENTION))
+    await db.execute(stmt)
+
+    stmt = text(config.JOBS_SQL_ABANDON)
+    stmt = stmt.bindparams(
+        p1=float(config.JOBS_STALE_AFTER), p2=config.JOBS_MAX_ATTEMPTS
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+
+def maintenance_due():
+    """True once every JOBS_MAINTENANCE_INTERVAL for the workers of the process"""
+    global maintained_at
+
+    now = monotonic()
+    if maintained_at is not None:
+        if now - maintained_at < config.JOBS_MAINTENANCE_INTERVAL:
+            return False
+    maintained_at = now
+    return True
+
+
+async def claim(db):
+    """Take the oldest job nobody is working on, or None"""
+    stmt = text(config.JOBS_SQL_CLAIM)
+    stmt = stmt.bindparams(
+        p1=float(config.JOBS_STALE_AFTER), p2=config.JOBS_MAX_ATTEMPTS
+    )
+    res = (await db.execute(stmt)).fetchone()
+    await db.commit()
+    if res is None:
+        return None
+
+    search = res[3] if isinstance(res[3], dict) else json.loads(res[3])
+    return {
+        "id": res[0],
+        "api_key": res[1],
+        "environment": res[2],
+        "search": SearchTerm(**search),
+    }
+
+
+async def heartbeat(job_id, progress):
+    while True:
+        await asyncio.sleep(config.JOBS_HEARTBEAT)
+        try:
+            async with cache.session_scope() as db:
+                stmt = text(config.JOBS_SQL_HEARTBEAT)
+                stmt = stmt.bindparams(p1=job_id, p2=progress["schedules"])
+                await db.execute(stmt)
+                await db.commit()
+        except Exception:
+            print(traceback.format_exc())
+
+
+async def finish(job_id, status, schedules, error):
+    async with cache.session_scope() as db:
+        stmt = text(config.JOBS_SQL_FINISH)
+        stmt = stmt.bindparams(p1=job_id, p2=status, p3=schedules, p4=error)
+        await db.execute(stmt)
+        await db.commit()
+
+
+async def run_job(job):
+    progress = {"schedules": 0}
+    beat = asyncio.get_running_loop().create_task(heartbeat(job["id"], progress))
+    try:
+        count = await sync.fetch_schedules(
+            job["search"],
+            job["environment"],
+            job["api_key"],
+            lambda count: progress.update(schedules=count),
+        )
+        await finish(job["id"], "done", count, None)
+    except Exception as e:
+        print(traceback.format_exc())
+        await finish(job["id"], "failed", progress["schedules"], str(e))
+    finally:
+        beat.cancel()
+
+
+async def work(stop: asyncio.Event = None):
+    """Process jobs until stop is set, polling every JOBS_POLL_INTERVAL when idle"""
+    stop = stop or asyncio.Event()
+    while not stop.is_set():
+        try:
+            async with cache.session_scope() as db:
+                if maintenance_due():
+                    await maintain(db)
+                job = await claim(db)
+            if job is not None:
+                await run_job(job)
+                continue
+        except Exception:
+            print(traceback.format_exc())
+
+        try:
+            await asyncio.wait_for(stop.wait(), config.JOBS_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_workers(count):
+    loop = asyncio.get_running_loop()
+    for i in range(count):
+        workers.append(loop.create_task(work()))
+
+
+async def stop_workers():
+    for task in workers:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    workers.clear()
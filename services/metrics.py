@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus metrics of the API, exposed by /metrics.
+Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(set by gunicorn.conf.py) and /metrics aggregates the files of all the
+workers, whichever worker answers the scrape.
+"""
+
+import os
+from time import perf_counter
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8)
+
+REQUEST_LATENCY = Histogram(
+    "iofmt_http_request_duration_seconds",
+    "Time to answer API requests, by route template",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_LATENCY = Histogram(
+    "iofmt_sfg20_request_duration_seconds",
+    "Time of the SFG20 GraphQL requests, body download included",
+    ["environment", "operation", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_SIZE = Histogram(
+    "iofmt_sfg20_response_bytes",
+    "Size of the SFG20 GraphQL responses",
+    ["environment", "operation"],
+    buckets=SIZE_BUCKETS,
+)
+DB_LATENCY = Histogram(
+    "iofmt_db_query_duration_seconds",
+    "Time of the statements sent to the cache database, by SQL command",
+    ["command"],
+)
+POOL_WAIT = Histogram(
+    "iofmt_db_pool_wait_seconds",
+    "Time spent waiting for a connection of the cache database pool",
+)
+POOL_CHECKED_OUT = Gauge(
+    "iofmt_db_pool_checked_out",
+    "Connections of the cache database in use",
+    multiprocess_mode="livesum",
+)
+POOL_CAPACITY = Gauge(
+    "iofmt_db_pool_capacity",
+    "Maximum connections of the cache database (pool size and overflow)",
+    multiprocess_mode="livesum",
+)
+RATE_LIMITED = Counter(
+    "iofmt_rate_limit_rejections_total",
+    "Requests rejected by the rate limiter",
+    ["endpoint"],
+)
+
+
+def observe_upstream(environment, operation, response, start):
+    """Record an SFG20 request; response is None when it failed without answer"""
+    status = "error" if response is None else str(response.status_code)
+    UPSTREAM_LATENCY.labels(environment, operation, status).observe(
+        perf_counter() - start
+    )
+    if response is not None:
+        UPSTREAM_SIZE.labels(environment, operation).observe(
+            response.num_bytes_downloaded
+        )
+
+
+def render():
+    """Return the metrics in the Prometheus text format and their content type"""
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
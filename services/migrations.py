@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned migrations of the cache database.
+Each file in data/migrations is named <version>_<name>.sql and is applied once,
+in version order. Applied versions are recorded in public.schema_migrations.
+"""
+
+import os
+import re
+
+from sqlalchemy import text
+
+from libs import config
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "..", "data", "migrations")
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+def list_migrations():
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(file_name)
+        if match:
+            migrations.append(
+                (
+                    int(match.group(1)),
+                    match.group(2),
+                    os.path.join(MIGRATIONS_DIR, file_name),
+                )
+            )
+    return sorted(migrations)
+
+
+def applied_versions(conn):
+    result = conn.execute(text(config.MIGRATIONS_SQL_SELECT)).fetchall()
+    return set([row[0] for row in result])
+
+
+def upgrade(engine):
+    """
+    Apply the pending migrations in a single transaction. An advisory lock
+    serialises the gunicorn workers that start at the same time.
+    Returns the list of versions applied.
+    """
+    applied = []
+    with engine.begin() as conn:
+        conn.execute(
+            text(config.MIGRATIONS_SQL_LOCK).bindparams(p1=config.MIGRATIONS_LOCK_ID)
+        )
+        conn.execute(text(config.MIGRATIONS_SQL_CREATE))
+        done = applied_versions(conn)
+
+        for version, name, path in list_migrations():
+            if version in done:
+                continue
+            with open(path, "r") as sql_file:
+                conn.exec_driver_sql(sql_file.read())
+            conn.execute(
+                text(config.MIGRATIONS_SQL_INSERT).bindparams(p1=version, p2=name)
+            )
+            applied.append(version)
+
+    return applied
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the statements sent to the cache database, from the cursor events
+of the engine. Each statement is recorded in the Prometheus metrics and in
+the statistics of the current request (a context variable set by the
+time_call middleware), and logged when slower than DB_SLOW_QUERY_SECONDS.
+"""
+
+import logging
+from contextvars import ContextVar
+from time import perf_counter
+
+from libs import config
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+current = ContextVar("query_stats", default=None)
+
+
+def start(path):
+    """Collect the statistics of the statements run by the request from now on"""
+    stats = {"path": path, "queries": 0, "seconds": 0.0}
+    return stats, current.set(stats)
+
+
+def stop(token):
+    current.reset(token)
+
+
+def shape(parameters):
+    """Types (and lengths of the arrays) of the bind parameters, not their values"""
+    if isinstance(parameters, dict):
+        return {key: shape(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [
+            (
+                f"{type(value).__name__}[{len(value)}]"
+                if isinstance(value, (list, tuple))
+                else type(value).__name__
+            )
+            for value in parameters
+        ]
+    return type(parameters).__name__
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, so a failed statement leaves nothing behind
+    context.query_start = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - context.query_start
+    command = statement.split(None, 1)[0].upper() if statement else ""
+    metrics.DB_LATENCY.labels(command).observe(elapsed)
+
+    stats = current.get()
+    if stats is not None:
+        stats["queries"] += 1
+        stats["seconds"] += elapsed
+
+    if 0 < config.DB_SLOW_QUERY_SECONDS <= elapsed:
+        logger.warning(
+            "Slow query (%.3f s) during %s: %s parameters %s",
+            elapsed,
+            "background work" if stats is None else stats["path"],
+            " ".join(statement.split()),
+            (
+                f"{len(parameters)} x {shape(parameters[0])}"
+                if executemany and len(parameters) > 0
+                else shape(parameters)
+            ),
+        )
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Token bucket rate limiter keyed by endpoint and API key.
+With the default RATE_LIMIT_BACKEND, "postgres", the buckets live in
+public.rate_limits and are shared by every gunicorn worker; each check is a
+single atomic upsert. "local" keeps them in the memory of the worker, for
+single-worker or development runs: each worker would apply the limit on its
+own.
+"""
+
+import logging
+import math
+from time import monotonic
+
+from sqlalchemy import text
+
+from libs import config
+from services import cache
+
+logger = logging.getLogger(__name__)
+
+buckets = {}
+
+
+async def acquire(bucket: str, max_calls: int, time_frame: int):
+    """
+    Take one token from the bucket, which holds up to max_calls tokens and
+    refills them over time_frame seconds.
+    Returns (allowed, seconds to wait before the next token is available)
+    """
+    rate = max_calls / time_frame
+    if config.RATE_LIMIT_BACKEND == "postgres":
+        try:
+            tokens, allowed = await acquire_shared(bucket, max_calls, rate)
+        except Exception:
+            # Do not turn a database hiccup into an outage of the API
+            logger.exception("Rate limiter unavailable, %s allowed", bucket)
+            return True, 0
+    else:
+        tokens, allowed = acquire_local(bucket, max_calls, rate)
+
+    if allowed:
+        return True, 0
+    return False, max(1, math.ceil((1 - tokens) / rate))
+
+
+def acquire_local(bucket, capacity, rate):
+    now = monotonic()
+    tokens, updated_at = buckets.get(bucket, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated_at) * rate)
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    buckets[bucket] = (tokens, now)
+    return tokens, allowed
+
+
+async def acquire_shared(bucket, capacity, rate):
+    async with cache.session_scope() as db:
+        stmt = text(config.RATE_LIMIT_SQL_ACQUIRE)
+        stmt = stmt.bindparams(p1=bucket, p2=float(capacity), p3=rate)
+        result = (await db.execute(stmt)).fetchone()
+        await db.commit()
+    return result[0], result[1]
@@ -1,44 +1,197 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import json
-import requests
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from operator import itemgetter
+
+import ijson
+from ijson.common import ObjectBuilder
 
 from libs import config
+from libs import timing
+from services import sfg20_client
 from entities.base import SearchTerm, Task, TaskGroup, ConfigSharedLinks
 
+SCHEDULES_PREFIX = "data.regime.schedules.item"
+NESTED = (list, dict)
+PLAIN = (str, type(None))
+
+pool = None
+pool_pid = None
+
+
+def compile_fields(type):
+    """
+    Compile the field specs of CACHE_DB_FIELDS[type] into the names and the
+    accessor functions of the record fields. A repeated name keeps its first
+    position and its last accessor, as successive assignments would
+    """
+    accessors = {}
+    for field in config.CACHE_DB_FIELDS[type]:
+        if "." in field:
+            parent, child = field.split(".")
+            accessors[child] = nested_getter(parent, child)
+        else:
+            accessors[field] = itemgetter(field)
+    return tuple(accessors), tuple(accessors.values())
+
+
+def nested_getter(parent, child):
+    def get(row):
+        value = row[parent]
+        if value is None:
+            return None
+        return value[child] or None
+
+    return get
+
+
+FIELDS = {type: compile_fields(type) for type in config.CACHE_DB_FIELDS}
+
 
 def parse_data(data, user, sharelink, key, type):
-    results = []
+    """
+    Turn the rows of one entity type of a schedule into cache records,
+    skipping the rows whose record is a duplicate of a previous one
+    """
+    transformer = Transformer(user, sharelink, key)
     for row in data:
-        record = {
-            "user_id": user,
-            "sharelink_id": sharelink,
-            "schedule_id": key,
-            "type": type,
-        }
-
-        for field in config.CACHE_DB_FIELDS[type]:
-            if "." in field:
-                field_parts = field.split(".")
-                if row[field_parts[0]] is not None:
-                    record[field_parts[1]] = row[field_parts[0]][field_parts[1]] or None
-                else:
-                    record[field_parts[1]] = None
-            else:
-                record[field] = row[field]
+        transformer.add(row, type)
+    return transformer.records[type]
+
+
+def identity(value):
+    """
+    Hashable stand-in of a scalar value, the same for two values only when
+    json.dumps writes them the same: 1, 1.0 and True are kept apart. Lists and
+    objects only stand for their class
+    """
+    cls = value.__class__
+    if cls in NESTED:
+        return cls
+    if cls is float:
+        return cls, repr(value)
+    return cls, value
 
+
+def nested_text(values):
+    return tuple([json.dumps(v) for v in values if v.__class__ in NESTED])
+
+
+class Transformer:
+    """Build the deduplicated cache records of one schedule, per entity type"""
+
+    def __init__(self, user, sharelink, key):
+        self.base = {"user_id": user, "sharelink_id": sharelink, "schedule_id": key}
+        self.records = {type: [] for type in FIELDS}
+        self.seen = {}
+
+    def add(self, row, type):
+        names, accessors = FIELDS[type]
+        values = tuple([accessor(row) for accessor in accessors])
+
+        # Records are grouped by their scalar values, lists and objects are
+        # only compared (by their JSON text) when those are the same
+        key = (
+            type,
+            tuple([v if v.__class__ in PLAIN else identity(v) for v in values]),
+        )
+        same_key = self.seen.setdefault(key, [])
+        if same_key:
+            text = nested_text(values)
+            if any(nested_text(seen) == text for seen in same_key):
+                return
+        same_key.append(values)
+
+        record = dict(self.base)
+        record["type"] = type
+        record.update(zip(names, values))
         if type == "tasks":
-            if len(record["id"].split(".")) == 4:
-                record["task_number"] = int(record["id"].split(".")[3]) + 1
-            else:
-                record["task_number"] = 1
-        results.append(record)
+            id_parts = record["id"].split(".")
+            record["task_number"] = int(id_parts[3]) + 1 if len(id_parts) == 4 else 1
+        self.records[type].append(record)
+
+
+def parse_schedule(raw_data, user, sharelink):
+    """
+    Transform one schedule of the regime in a single pass: the tasks are
+    walked once to produce both the task and the classification records
+    """
+    transformer = Transformer(user, sharelink, raw_data["id"])
+    transformer.add(raw_data, "schedules")
+    for row in raw_data["skills"]:
+        transformer.add(row, "skills")
+    for row in raw_data["tasks"]:
+        transformer.add(row, "tasks")
+        transformer.add(row, "classification")
+    for row in raw_data["assets"]:
+        transformer.add(row, "assets")
+    for row in raw_data["frequencies"]:
+        transformer.add(row, "frequencies")
+
+    records = transformer.records
+    return dict(
+        schedule=records["schedules"],
+        skills=records["skills"],
+        tasks=records["tasks"],
+        assets=records["assets"],
+        frequencies=records["frequencies"],
+        classifications=records["classification"],
+    )
+
+
+def get_pool():
+    """
+    Process pool that parses the schedules of large regimes. The processes are
+    spawned rather than forked, as the worker already runs threads
+    """
+    global pool, pool_pid
+
+    if pool is None or pool_pid != os.getpid():
+        pool = ProcessPoolExecutor(
+            max_workers=config.SFG20_PARSE_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        pool_pid = os.getpid()
+    return pool
+
 
-    results = [json.loads(x) for x in set([json.dumps(d) for d in results])]
-    return results
+def close_pool():
+    global pool
 
+    if pool is not None and pool_pid == os.getpid():
+        pool.shutdown(wait=False, cancel_futures=True)
+    pool = None
 
-def retrieve_all_data(searchItem: SearchTerm, environment: str):
+
+def discard_pool(broken):
+    """Drop a pool one of whose processes died, unless it was already replaced"""
+    if broken is not None and broken is pool:
+        close_pool()
+
+
+def use_pool(size):
+    threshold = config.SFG20_PARSE_PROCESS_THRESHOLD
+    return threshold > 0 and size > threshold
+
+
+async def stream_all_data(searchItem: SearchTerm, environment: str):
+    """
+    Download the regime and yield the parsed content of each schedule as soon
+    as its JSON has arrived, so only one schedule is held in memory at a time.
+    Once the regime is known to be larger than SFG20_PARSE_PROCESS_THRESHOLD
+    the schedules are parsed in the process pool, in order, with up to
+    SFG20_PARSE_IN_FLIGHT of them waiting for their result. If a process of
+    the pool dies (killed when out of memory) the sync fails and the pool is
+    replaced for the next ones.
+    An answer with GraphQL errors raises, as an HTTP error does, so that the
+    caller does not take a partial regime for a complete one.
+    """
     since_date = searchItem.changes_since
     if searchItem.changes_since is None:
         since_date = "2000-01-01T00:00:00Z"
@@ -46,69 +199,93 @@ def retrieve_all_data(searchItem: SearchTerm, environment: str):
     query = config.SFG20_QUERY_001.format(
         searchItem.sharelink_id, searchItem.access_token, since_date
     )
-    # print(query)
-    body = {
-        "query": query,
-    }
 
-    response = requests.post(config.SFG20_ENVS[environment], json=body)
-    if response.status_code == 200:
-        raw_data = response.json()
-        if "errors" in raw_data:
-            return []
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    async with sfg20_client.stream(environment, query, "regime") as response:
+        if response.status_code != 200:
+            raise Exception(f"SFG20 returned HTTP {response.status_code}")
+
+        size = int(response.headers.get("content-length", 0))
+        received = 0
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events, use_float=True)
+        builder = None
+        executor = None
+        chunks = response.aiter_bytes()
+        errors = []
+        try:
+            while True:
+                with timing.phase("sfg20"):
+                    chunk = await anext(chunks, None)
+                if chunk is None:
+                    parser.close()
+                    break
+                received += len(chunk)
+
+                # Schedules of the chunk parsed here come before those sent
+                # to the pool: the pool is used from a size onwards
+                parsed = []
+                with timing.phase("parse"):
+                    parser.send(chunk)
+                    for prefix, event, value in events:
+                        if builder is not None:
+                            builder.event(event, value)
+                            if prefix == SCHEDULES_PREFIX and event == "end_map":
+                                args = (
+                                    builder.value,
+                                    searchItem.user_id,
+                                    searchItem.sharelink_id,
+                                )
+                                builder = None
+                                if use_pool(max(size, received)):
+                                    executor = get_pool()
+                                    pending.append(
+                                        loop.run_in_executor(
+                                            executor, parse_schedule, *args
+                                        )
+                                    )
+                                else:
+                                    parsed.append(parse_schedule(*args))
+                        elif prefix == SCHEDULES_PREFIX and event == "start_map":
+                            builder = ObjectBuilder()
+                            builder.event(event, value)
+                        elif prefix == "errors.item" and event == "start_map":
+                            errors.append("")
+                        elif prefix == "errors.item.message":
+                            errors[-1] = str(value)
+                        elif prefix == "errors" and event == "end_array" and errors:
+                            raise Exception(
+                                f"SFG20 returned errors: {'; '.join(errors)}"
+                            )
+                    del events[:]
+
+                for content in parsed:
+                    yield content
+                while len(pending) > config.SFG20_PARSE_IN_FLIGHT or (
+                    pending and pending[0].done()
+                ):
+                    with timing.phase("parse"):
+                        content = await pending.popleft()
+                    yield content
+
+            while pending:
+                with timing.phase("parse"):
+                    content = await pending.popleft()
+                yield content
+        except BrokenProcessPool:
+            discard_pool(executor)
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
 
-        all_data = response.json()["data"]["regime"]["schedules"]
-        schedules = []
-        for raw_data in all_data:
-            content = dict(
-                schedule=parse_data(
-                    [raw_data],
-                    searchItem.user_id,
-                    searchItem.sharelink_id,
-                    raw_data["id"],
-                    "schedules",
-                ),
-                skills=parse_data(
-                    raw_data["skills"],
-                    searchItem.user_id,
-                    searchItem.sharelink_id,
-                    raw_data["id"],
-                    "skills",
-                ),
-                tasks=parse_data(
-                    raw_data["tasks"],
-                    searchItem.user_id,
-                    searchItem.sharelink_id,
-                    raw_data["id"],
-                    "tasks",
-                ),
-                assets=parse_data(
-                    raw_data["assets"],
-                    searchItem.user_id,
-                    searchItem.sharelink_id,
-                    raw_data["id"],
-                    "assets",
-                ),
-                frequencies=parse_data(
-                    raw_data["frequencies"],
-                    searchItem.user_id,
-                    searchItem.sharelink_id,
-                    raw_data["id"],
-                    "frequencies",
-                ),
-                classifications=parse_data(
-                    raw_data["tasks"],
-                    searchItem.user_id,
-                    searchItem.sharelink_id,
-                    raw_data["id"],
-                    "classification",
-                ),
-            )
-            schedules.append(content)
-    return schedules
 
+async def retrieve_all_data(searchItem: SearchTerm, environment: str):
+    return [content async for content in stream_all_data(searchItem, environment)]
 
-def complete_task(task: Task, environment: str):
+
+async def complete_task(task: Task, environment: str):
     query = config.SFG20_QUERY_002.format(
         task.sharelink_id,
         task.access_token,
@@ -118,16 +295,12 @@ def complete_task(task: Task, environment: str):
         task.completion_date,
     )
 
-    body = {
-        "query": query,
-    }
-
-    print(body)
-    response = requests.post(config.SFG20_ENVS[environment], json=body)
+    print(query)
+    response = await sfg20_client.post(environment, query, "complete_task")
     return response.json()
 
 
-def complete_task_group(task: TaskGroup, environment: str):
+async def complete_task_group(task: TaskGroup, environment: str):
     items = []
     for item in task.tasks_completed:
         record = config.SFG20_QUERY_003_ITEM.format(
@@ -149,25 +322,19 @@ def complete_task_group(task: TaskGroup, environment: str):
 
     print(query)
 
-    body = {
-        "query": query,
-    }
-
-    response = requests.post(config.SFG20_ENVS[environment], json=body)
+    response = await sfg20_client.post(environment, query, "complete_task_group")
     return response.json()
 
 
-def load_shared_links(searchItem: ConfigSharedLinks, api_key: str, environment: str):
+async def load_shared_links(
+    searchItem: ConfigSharedLinks, api_key: str, environment: str
+):
     links = []
     query = config.SFG20_QUERY_004.format(
         searchItem.sharelink_id, searchItem.access_token
     )
 
-    body = {
-        "query": query,
-    }
-
-    response = requests.post(config.SFG20_ENVS[environment], json=body)
+    response = await sfg20_client.post(environment, query, "shared_links")
     if response.status_code == 200:
         all_data = response.json()["data"]["batchRegimes"]
         for raw_data in all_data:
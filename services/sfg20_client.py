@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Shared asynchronous HTTP client for the SFG20 GraphQL API.
+One keep-alive connection pool is kept per SFG20 environment
+"""
+
+from contextlib import asynccontextmanager
+from time import perf_counter
+
+import httpx
+
+from libs import config
+from libs import timing
+from services import metrics
+
+clients = {}
+
+
+def get_client(environment: str) -> httpx.AsyncClient:
+    client = clients.get(environment)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=config.SFG20_HTTP2,
+            limits=httpx.Limits(
+                max_connections=config.SFG20_MAX_CONNECTIONS,
+                max_keepalive_connections=config.SFG20_MAX_KEEPALIVE,
+                keepalive_expiry=config.SFG20_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                config.SFG20_TIMEOUT, connect=config.SFG20_CONNECT_TIMEOUT
+            ),
+        )
+        clients[environment] = client
+    return client
+
+
+async def post(environment: str, query: str, operation: str) -> httpx.Response:
+    client = get_client(environment)
+    start = perf_counter()
+    response = None
+    try:
+        response = await client.post(
+            config.SFG20_ENVS[environment], json={"query": query}
+        )
+        return response
+    finally:
+        timing.add("sfg20", perf_counter() - start)
+        metrics.observe_upstream(environment, operation, response, start)
+
+
+@asynccontextmanager
+async def stream(environment: str, query: str, operation: str):
+    """
+    Stream the response; its metrics cover the download of the whole body.
+    The sfg20 phase only counts the wait for the headers, the caller times
+    the reads of the body
+    """
+    client = get_client(environment)
+    start = perf_counter()
+    response = None
+    try:
+        async with client.stream(
+            "POST", config.SFG20_ENVS[environment], json={"query": query}
+        ) as response:
+            timing.add("sfg20", perf_counter() - start)
+            yield response
+    finally:
+        metrics.observe_upstream(environment, operation, response, start)
+
+
+async def close_clients():
+    for client in clients.values():
+        await client.aclose()
+    clients.clear()
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Synchronise the SFG20 regime of a share link into the cache.
+The time of the last successful sync of every (user_id, sharelink_id) is kept
+as a watermark and sent to SFG20 as changesSince, so only the schedules that
+changed since then are downloaded and merged into sfg20_data.
+
+Cached regimes are served while they are younger than SCHEDULES_MAX_AGE, and
+refreshed in the background once they are older (stale-while-revalidate).
+A periodic refresher keeps the share links of config_shared_links warm.
+
+Identical fetches (same environment, user, share link and changes_since) are
+coalesced: within a worker the callers share one task, across workers an
+advisory lock lets one of them fetch and the others reuse its result.
+"""
+
+import asyncio
+import contextvars
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from libs import config
+from libs import timing
+from services import cache
+from services import sfg20 as sv_sfg20
+from entities.base import SearchTerm
+
+WATERMARK_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+flights = {}
+background = set()
+refresher = None
+
+
+async def sync_schedules(
+    search: SearchTerm, environment: str, db, api_key=None, progress=None
+):
+    """
+    Download the schedules changed since the watermark (or since the
+    changes_since given by the caller) and merge them into the cache in one
+    transaction. Returns the number of schedules merged; their IDs are kept
+    with the single-flight key, for the answer of a changes_since call.
+    progress, when given, is called with the number of schedules downloaded.
+
+    Schedules removed from a share link are not reported by a delta sync;
+    pass changes_since="2000-01-01T00:00:00Z" to force a full refresh.
+    """
+    started_at = datetime.now(timezone.utc)
+    key = flight_key(search, environment)
+
+    use_watermark = search.changes_since is None
+    if use_watermark:
+        watermark = await cache.get_watermark(search.user_id, search.sharelink_id, db)
+        if watermark is not None:
+            search = search.model_copy(update={"changes_since": watermark})
+
+    count = 0
+    schedule_ids = []
+    try:
+        batch = []
+        batch_rows = 0
+        async for item in sv_sfg20.stream_all_data(search, environment):
+            batch.append(item)
+            batch_rows += sum(len(item[key]) for key in item)
+            if batch_rows >= config.CACHE_WRITE_BATCH_ROWS:
+                with timing.phase("save"):
+                    await cache.save_cache_bulk(batch, db)
+                batch = []
+                batch_rows = 0
+            count += 1
+            schedule_ids.append(item["schedule"][0]["schedule_id"])
+            if progress is not None:
+                progress(count)
+        with timing.phase("save"):
+            await cache.save_cache_bulk(batch, db)
+
+        if use_watermark:
+            since = started_at - timedelta(seconds=config.SYNC_WATERMARK_OVERLAP)
+            await cache.set_watermark(
+                search.user_id,
+                search.sharelink_id,
+                since.strftime(WATERMARK_FORMAT),
+                api_key,
+                db,
+            )
+        await cache.set_flight(key, count, db, schedule_ids)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+
+    return count
+
+
+async def revalidate(search: SearchTerm, environment: str, api_key, db):
+    """
+    Apply the freshness policy of /schedules. Returns the number of schedules
+    merged and how the request was served:
+    "synced" - the share link was synced before answering (never synced
+    before, or changes_since given by the caller)
+    "fresh" - answered from the cache
+    "stale" - answered from the cache while a background task refreshes it
+    """
+    state = None
+    if search.changes_since is None:
+        state = await cache.get_sync_state(search.user_id, search.sharelink_id, db)
+
+    if state is None:
+        # The sync has its own connection; do not keep this one idle meanwhile
+        await db.commit()
+        count = await fetch_schedules(search, environment, api_key)
+        return count, "synced"
+
+    age = state[1]
+    if age is not None and age <= config.SCHEDULES_MAX_AGE:
+        return 0, "fresh"
+
+    refresh_in_background(search, environment, api_key)
+    return 0, "stale"
+
+
+async def needs_fetch(search: SearchTerm, db):
+    """True when /schedules can not answer from the cache before a fetch"""
+    if search.changes_since is not None:
+        return True
+    return await cache.get_sync_state(search.user_id, search.sharelink_id, db) is None
+
+
+def flight_key(search: SearchTerm, environment: str):
+    return "|".join(
+        [
+            environment,
+            search.user_id,
+            search.sharelink_id,
+            search.changes_since or "",
+        ]
+    )
+
+
+async def fetch_schedules(
+    search: SearchTerm, environment: str, api_key=None, progress=None
+):
+    """
+    sync_schedules in its own session, coalesced with the identical fetches
+    running in this worker. A caller that goes away does not cancel it.
+    Only the caller that starts the fetch receives its progress
+    """
+    with timing.phase("sync"):
+        return await asyncio.shield(
+            start_flight(search, environment, api_key, progress)
+        )
+
+
+def start_flight(search: SearchTerm, environment: str, api_key, progress=None):
+    key = flight_key(search, environment)
+    task = flights.get(key)
+    if task is None:
+        task = spawn(run_flight(search, environment, api_key, key, progress))
+        flights[key] = task
+        task.add_done_callback(lambda done: land(key, done))
+    return task
+
+
+def spawn(coro):
+    """
+    Task of coro in a fresh context: the request that happens to start it
+    does not collect the timings and the query statistics of the task
+    """
+    return asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+
+
+def land(key, task):
+    if flights.get(key) is task:
+        del flights[key]
+
+
+async def run_flight(search: SearchTerm, environment: str, api_key, key, progress):
+    """
+    Fetch under the advisory lock of the key. A worker that had to wait for
+    the lock returns the number of schedules of the fetch that finished in the
+    meantime instead of downloading the regime again. While it waits it polls
+    the lock every SYNC_LOCK_POLL seconds and gives its connection back to
+    the pool in between. The fetch holds one connection, in one transaction,
+    for its whole download
+    """
+    async with cache.session_scope() as db:
+        locked, started_at = await cache.try_lock_flight(key, db)
+        while not locked:
+            await db.rollback()
+            await asyncio.sleep(config.SYNC_LOCK_POLL)
+            locked = (await cache.try_lock_flight(key, db))[0]
+
+        count = await cache.get_flight(key, started_at, db)
+        if count is not None:
+            await db.commit()
+            return count
+        return await sync_schedules(search, environment, db, api_key, progress)
+
+
+def refresh_in_background(search: SearchTerm, environment: str, api_key):
+    """Start a refresh of the share link unless one is already running"""
+    if flight_key(search, environment) not in flights:
+        task = spawn(refresh(search, environment, api_key))
+        background.add(task)
+        task.add_done_callback(background.discard)
+
+
+async def refresh(search: SearchTerm, environment: str, api_key):
+    try:
+        return await fetch_schedules(search, environment, api_key)
+    except Exception:
+        print(traceback.format_exc())
+
+
+async def refresh_stale_links():
+    """
+    Refresh the share links of config_shared_links older than
+    SCHEDULES_MAX_AGE. The cache is kept per user, so only the links some
+    user has synced before (those of sfg20_sync) are refreshed, for each of
+    their users. A session-level advisory lock, held for the whole round on
+    a connection outside any transaction, lets a single worker do it.
+    Returns the number of share links refreshed
+    """
+    async with cache.session_lock(config.SCHEDULES_REFRESH_LOCK_ID) as locked:
+        if not locked:
+            return 0
+
+        async with cache.session_scope() as db:
+            links = await cache.select_stale_links(config.SCHEDULES_MAX_AGE, db)
+        for link in links:
+            search = SearchTerm(
+                sharelink_id=link["sharelink_id"],
+                access_token=link["access_token"],
+                user_id=link["user_id"],
+            )
+            await refresh(search, link["sfg_environment"], link["api_key"])
+    return len(links)
+
+
+async def refresh_links():
+    while True:
+        await asyncio.sleep(config.SCHEDULES_REFRESH_INTERVAL)
+        try:
+            await refresh_stale_links()
+        except Exception:
+            print(traceback.format_exc())
+
+
+def start_refresher():
+    global refresher
+
+    if config.SCHEDULES_REFRESH_INTERVAL > 0 and (
+        refresher is None or refresher.done()
+    ):
+        refresher = asyncio.get_running_loop().create_task(refresh_links())
+
+
+async def stop_refresher():
+    global refresher
+
+    for task in list(background) + list(flights.values()) + [refresher]:
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    refresher = None
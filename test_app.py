@@ -1,12 +1,99 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import httpx
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import text
 from app import app
+from benchmarks import regime
+from benchmarks import sfg20_stub
+from benchmarks import transform
+from entities.base import CacheParameters, SearchTerm, SharedLinks
 from routers.security_router import APIKey, get_api_key
+from libs import config
+from libs import timing
+from libs.responses import FastJSONResponse, RawJSON
+from services import api_keys
+from services import cache
+from services import codec
+from services import jobs
+from services import query_stats
+from services import rate_limit
+from services import sfg20
+from services import sfg20_client
+from services import sync
 
 client = TestClient(app)
 header = {"X-Access-Token": "iofmt2024@"}
 
 
+@pytest.fixture
+def stub(monkeypatch):
+    """The DEMO environment served by the local SFG20 stub, in process"""
+    monkeypatch.setattr(sfg20_stub, "STUB_LATENCY", 0)
+    monkeypatch.setattr(sfg20_stub, "revisions", [regime.EPOCH])
+    monkeypatch.setattr(sfg20_stub, "regimes", {})
+    monkeypatch.setitem(config.SFG20_ENVS, "DEMO", "http://sfg20-stub/graphql")
+    transport = httpx.ASGITransport(app=sfg20_stub.app)
+    monkeypatch.setitem(
+        sfg20_client.clients, "DEMO", httpx.AsyncClient(transport=transport)
+    )
+    return sfg20_stub
+
+
+@pytest.fixture
+def demo_key(stub):
+    """An API key of the DEMO environment, removed with its jobs and cache"""
+    names = {"user": "test_api_user", "key": "test_api_key"}
+    setup = [
+        "INSERT INTO config (api_key, customer_name, access_token, sfg_environment) "
+        "VALUES (:key, 'API test', 'valid', 'DEMO')",
+    ]
+    cleanup = [
+        "DELETE FROM sync_jobs WHERE api_key = :key",
+        "DELETE FROM sfg20_sync WHERE user_id = :user",
+        "DELETE FROM sfg20_data WHERE user_id = :user",
+        "DELETE FROM config_shared_links WHERE api_key = :key",
+        "DELETE FROM config WHERE api_key = :key",
+    ]
+
+    async def execute(statements, db):
+        for statement in statements:
+            await db.execute(text(statement), names)
+        await db.commit()
+
+    run_sync(lambda db: execute(cleanup + setup, db))
+    yield names
+    run_sync(lambda db: execute(cleanup, db))
+
+
+def count_regimes(stub, monkeypatch):
+    """List of the share links of the regime queries answered by the stub"""
+    calls = []
+    regime_body = stub.regime_body
+
+    def counted(sharelink_id, changes_since):
+        calls.append(sharelink_id)
+        return regime_body(sharelink_id, changes_since)
+
+    monkeypatch.setattr(stub, "regime_body", counted)
+    return calls
+
+
+def run_sync(coroutine):
+    """Run coroutine(db) with a cache session"""
+
+    async def run():
+        async with cache.session_scope() as db:
+            return await coroutine(db)
+
+    return asyncio.run(run())
+
+
 def test_get_root():
     response = client.get("/")
     assert response.status_code == 200
@@ -61,6 +148,46 @@ def test_get_shared_links():
     assert response.json()["data"][0]["url"] == "test_url"
 
 
+def test_upsert_shared_links(demo_key, monkeypatch):
+    select = text(
+        "SELECT id, link_name FROM config_shared_links WHERE api_key = :key ORDER BY id"
+    )
+
+    def links(name):
+        return [
+            {"api_key": demo_key["key"], "id": id, "link_name": name, "url": "url"}
+            for id in ["l2", "l1", "l2"]
+        ]
+
+    async def upsert(name):
+        shared = [SharedLinks(**link) for link in links(name)]
+        async with cache.session_scope() as db:
+            await cache.upsert_shared_links(demo_key["key"], shared, db)
+
+    async def stored(db):
+        return [tuple(row) for row in (await db.execute(select, demo_key)).all()]
+
+    async def run(db):
+        # Concurrent first listings of the same links all succeed
+        await asyncio.gather(*[upsert("first") for i in range(4)])
+        return await stored(db)
+
+    assert run_sync(run) == [("l1", "first"), ("l2", "first")]
+
+    async def load_shared_links(item, api_key, environment):
+        return links("renamed")
+
+    monkeypatch.setattr(sfg20, "load_shared_links", load_shared_links)
+    response = client.post(
+        "/shared-links",
+        json={"sharelink_id": "bench-3", "access_token": "valid"},
+        headers={"X-Access-Token": demo_key["key"]},
+    )
+    assert response.status_code == 200
+    assert [link["name"] for link in response.json()["data"]] == ["renamed"] * 3
+    assert run_sync(stored) == [("l1", "renamed"), ("l2", "renamed")]
+
+
 def test_get_shared_links_config():
     header2 = {"X-Access-Token": "test_key"}
     response = client.get("/config/shared_links", headers=header2)
@@ -91,6 +218,623 @@ def test_config_delete():
     assert response.json()["status"] == "OK"
 
 
+def test_get_from_cache_page():
+    params = {"user_id": "test_user", "sharelink_id": "test_link", "limit": 10}
+    response = client.get("/cache", params=params, headers=header)
+    assert response.status_code == 200
+    assert response.json()["status"] == "OK"
+    assert "nextLink" not in response.json()
+
+
+def test_get_job_not_found():
+    response = client.get("/jobs/unknown", headers=header)
+    assert response.status_code == 404
+
+
+def test_db_debug_headers():
+    response = client.get("/jobs/unknown", headers=header)
+    assert int(response.headers["X-DB-Queries"]) >= 1
+    assert float(response.headers["X-DB-Time"]) > 0
+    response = client.get("/jobs/unknown", headers={"X-Access-Token": "test_key"})
+    assert "X-DB-Queries" not in response.headers
+
+
+def test_server_timing():
+    response = client.get("/jobs/unknown", headers=header)
+    phases = [
+        entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")
+    ]
+    assert phases[-2:] == ["db", "total"]
+
+
+def test_timing_log_sample(monkeypatch, caplog):
+    monkeypatch.setattr(config, "TIMING_LOG_SAMPLE", 1)
+    with caplog.at_level(logging.INFO, logger="libs.timing"):
+        client.get("/jobs/unknown", headers=header)
+    logged = json.loads(caplog.records[-1].getMessage())
+    assert logged["event"] == "timing"
+    assert logged["route"] == "/jobs/{id}"
+    assert "total" in logged["ms"]
+
+
+def test_metrics_requires_admin():
+    response = client.get("/metrics")
+    assert response.status_code == 401
+
+
+def test_raw_json_response():
+    content = {"status": "OK", "data": RawJSON(['{"a": 1}', "[2]"]), "nextLink": "x"}
+    response = FastJSONResponse(content)
+    assert response.body == b'{"status":"OK","data":[{"a": 1},[2]],"nextLink":"x"}'
+    assert FastJSONResponse({"data": RawJSON([])}).body == b'{"data":[]}'
+
+
+def test_codec_roundtrip(monkeypatch):
+    monkeypatch.setattr(config, "CACHE_CODEC", "zstd")
+    task = {"type": "tasks", "id": "t1", "content": "<p>Check</p>", "steps": [1]}
+    data, payload = codec.encode(task, None)
+    assert json.loads(data) == {"type": "tasks", "id": "t1"}
+    assert codec.decode(json.loads(data), payload, None) == task
+    assert json.loads(codec.decode(data, payload, None, raw=True)) == task
+    assert codec.encode({"type": "assets", "id": "a1"}, None)[1] is None
+
+
+def test_rate_limit_retry_after(monkeypatch):
+    monkeypatch.setattr(config, "RATE_LIMIT_BACKEND", "local")
+    for i in range(3):
+        assert asyncio.run(rate_limit.acquire("test:test_key", 3, 60)) == (True, 0)
+    assert asyncio.run(rate_limit.acquire("test:test_key", 3, 60)) == (False, 20)
+    assert asyncio.run(rate_limit.acquire("test:other_key", 3, 60)) == (True, 0)
+
+
+def test_rate_limit_shared(monkeypatch):
+    monkeypatch.setattr(config, "RATE_LIMIT_BACKEND", "postgres")
+    buckets = ["test:shared_key", "test:other_shared_key"]
+
+    async def run(db):
+        stmt = text("DELETE FROM rate_limits WHERE bucket = ANY(:p1)")
+        await db.execute(stmt.bindparams(p1=buckets))
+        await db.commit()
+        results = [await rate_limit.acquire(buckets[0], 3, 60) for i in range(4)]
+        results.append(await rate_limit.acquire(buckets[1], 3, 60))
+        # The buckets are rows, not state of this worker
+        rate_limit.buckets.clear()
+        results.append(await rate_limit.acquire(buckets[0], 3, 60))
+        await db.execute(stmt.bindparams(p1=buckets))
+        await db.commit()
+        return results
+
+    assert run_sync(run) == [(True, 0)] * 3 + [(False, 20), (True, 0), (False, 20)]
+
+
+def test_rate_limit_shared_fails_open(monkeypatch, caplog):
+    async def acquire_shared(bucket, capacity, rate):
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(config, "RATE_LIMIT_BACKEND", "postgres")
+    monkeypatch.setattr(rate_limit, "acquire_shared", acquire_shared)
+    assert asyncio.run(rate_limit.acquire("test:test_key", 3, 60)) == (True, 0)
+    assert "Rate limiter unavailable" in caplog.text
+
+
+def test_parse_schedule():
+    task = {
+        "id": "s1.t.0.2",
+        "title": "Task",
+        "classification": "Red",
+        "frequency": None,
+        "minutes": 0,
+        "date": None,
+        "url": None,
+        "linkId": None,
+        "content": None,
+        "fullContent": None,
+        "fullHtmlContent": None,
+        "skill": {"CoreSkillingID": 1, "Skilling": ""},
+        "schedule": {"code": "01-01", "version": 1},
+        "steps": [{"step": 1}],
+        "_status": None,
+    }
+    other = dict(task, id="s1.t.1", steps=[{"step": 2}])
+    raw_data = {
+        "id": "s1",
+        "code": "01-01",
+        "title": "Schedule",
+        "rawTitle": "Schedule",
+        "version": 1,
+        "skills": [],
+        "tasks": [task, dict(task), other],
+        "assets": [],
+        "frequencies": [{"label": "Monthly"}, {"label": "Monthly"}],
+    }
+    parsed = sfg20.parse_schedule(raw_data, "u1", "l1")
+    assert [t["task_number"] for t in parsed["tasks"]] == [3, 1]
+    assert parsed["tasks"][0]["interval"] is None
+    assert parsed["tasks"][0]["Skilling"] is None
+    assert parsed["tasks"][0]["schedule_id"] == "s1"
+    assert [c["classification"] for c in parsed["classifications"]] == ["Red"]
+    assert len(parsed["frequencies"]) == 1
+    assert parsed["schedule"][0]["type"] == "schedules"
+
+
+def test_parse_schedule_keeps_value_types():
+    # Rows are duplicates only when their records have the same JSON text
+    task = {
+        "id": "s1.t.0",
+        "title": "Task",
+        "classification": "Red",
+        "frequency": None,
+        "minutes": 1,
+        "date": None,
+        "url": None,
+        "linkId": None,
+        "content": None,
+        "fullContent": None,
+        "fullHtmlContent": None,
+        "skill": None,
+        "schedule": None,
+        "steps": [{"critical": 1}],
+        "_status": None,
+    }
+    tasks = [
+        task,
+        dict(task),
+        dict(task, minutes=True),
+        dict(task, minutes=1.0),
+        dict(task, steps=[{"critical": True}]),
+        dict(task, steps=[{"critical": 1.0}]),
+        dict(task, steps=[{"critical": 1}]),
+    ]
+    raw_data = {
+        "id": "s1",
+        "code": "01-01",
+        "title": "Schedule",
+        "rawTitle": "Schedule",
+        "version": 1,
+        "skills": [],
+        "tasks": tasks,
+        "assets": [],
+        "frequencies": [],
+    }
+    parsed = sfg20.parse_schedule(raw_data, "u1", "l1")
+    assert [(t["minutes"], t["steps"]) for t in parsed["tasks"]] == [
+        (1, [{"critical": 1}]),
+        (True, [{"critical": 1}]),
+        (1.0, [{"critical": 1}]),
+        (1, [{"critical": True}]),
+        (1, [{"critical": 1.0}]),
+    ]
+    assert transform.canonical(parsed) == transform.canonical(
+        transform.legacy_parse_schedule(raw_data, "u1", "l1")
+    )
+
+
+def test_stream_all_data(stub, monkeypatch):
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3x4", access_token="valid"
+    )
+
+    async def stream():
+        return [content async for content in sfg20.stream_all_data(search, "DEMO")]
+
+    parsed = asyncio.run(stream())
+    assert [data["schedule"][0]["id"] for data in parsed] == ["sch-0", "sch-1", "sch-2"]
+    assert [len(data["tasks"]) for data in parsed] == [4, 4, 4]
+
+    # Schedules split across chunks of the answer parse the same
+    class Chunked(httpx.ASGITransport):
+        async def handle_async_request(self, request):
+            response = await super().handle_async_request(request)
+            body = await response.aread()
+
+            async def chunks():
+                for i in range(0, len(body), 100):
+                    yield body[i : i + 100]
+
+            return httpx.Response(response.status_code, content=chunks())
+
+    chunked = httpx.AsyncClient(transport=Chunked(app=stub.app))
+    monkeypatch.setitem(sfg20_client.clients, "DEMO", chunked)
+    assert asyncio.run(stream()) == parsed
+
+    # And so do schedules parsed in the process pool, in order
+    monkeypatch.setattr(config, "SFG20_PARSE_PROCESS_THRESHOLD", 1)
+    try:
+        assert asyncio.run(stream()) == parsed
+    finally:
+        sfg20.close_pool()
+
+
+@pytest.mark.parametrize("write_mode", ["insert", "copy"])
+def test_save_cache_bulk_merges_rows(monkeypatch, write_mode):
+    monkeypatch.setattr(config, "CACHE_WRITE_MODE", write_mode)
+    item = CacheParameters(
+        user_id="test_cache_user", sharelink_id="test_link", type="tasks"
+    )
+    first, second = [
+        regime.make_schedule(index, tasks=4, duplicate_rate=0) for index in range(2)
+    ]
+
+    def parse(*schedules):
+        return [
+            sfg20.parse_schedule(raw_data, item.user_id, item.sharelink_id)
+            for raw_data in schedules
+        ]
+
+    async def run(db):
+        await cache.clear_cache(item.user_id, db)
+        await cache.save_cache_bulk(parse(first, second), db)
+        assert len(await cache.list_cache(item, db)) == 8
+
+        # The first schedule lost a task and another one changed
+        removed = first["tasks"].pop(0)
+        first["tasks"][0]["minutes"] = 999
+        await cache.save_cache_bulk(parse(first), db)
+        tasks = {task["id"]: task for task in await cache.list_cache(item, db)}
+        assert len(tasks) == 7
+        assert removed["id"] not in tasks
+        assert tasks[first["tasks"][0]["id"]]["minutes"] == 999
+        assert all([task["id"] in tasks for task in second["tasks"]])
+        await cache.clear_cache(item.user_id, db)
+
+    run_sync(run)
+
+
+def test_delta_sync_from_watermark(stub, monkeypatch):
+    monkeypatch.setattr(stub, "STUB_CHANGE_RATE", 0.5)
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-10", access_token="valid"
+    )
+    changed = [index for index in range(10) if regime.changed(index, 1, 0.5)]
+    item = CacheParameters(
+        user_id=search.user_id, sharelink_id="bench-10", type="schedules"
+    )
+
+    async def run(db):
+        await cache.clear_cache(search.user_id, db)
+        assert await sync.sync_schedules(search, "DEMO", db) == 10
+        assert await cache.get_watermark(search.user_id, "bench-10", db) is not None
+        # Nothing changed since the watermark
+        assert await sync.sync_schedules(search, "DEMO", db) == 0
+
+        await stub.add_revision()
+        assert changed
+        assert await sync.sync_schedules(search, "DEMO", db) == len(changed)
+        versions = {
+            row["id"]: row["version"] for row in await cache.list_cache(item, db)
+        }
+        assert len(versions) == 10
+        assert [
+            index for index in range(10) if versions[f"sch-{index}"] == 2
+        ] == changed
+        await cache.clear_cache(search.user_id, db)
+
+    run_sync(run)
+
+
+def test_stream_cache_ndjson(stub, monkeypatch):
+    monkeypatch.setattr(config, "CACHE_STREAM_BATCH", 5)
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3x4", access_token="valid"
+    )
+    item = CacheParameters(
+        user_id=search.user_id, sharelink_id="bench-3x4", order_field="title"
+    )
+
+    async def ndjson(item):
+        return "".join([chunk async for chunk in cache.stream_cache(item)])
+
+    async def run(db):
+        await cache.clear_cache(search.user_id, db)
+        await sync.sync_schedules(search, "DEMO", db)
+        listed = await cache.list_cache(item, db)
+        lines = (await ndjson(item)).splitlines()
+        assert len(lines) > 5
+        assert [json.loads(line) for line in lines] == listed
+
+        limited = item.model_copy(update={"limit": 7})
+        lines = (await ndjson(limited)).splitlines()
+        assert [json.loads(line) for line in lines] == listed[:7]
+        await cache.clear_cache(search.user_id, db)
+
+    run_sync(run)
+
+
+def test_fetches_are_coalesced(stub, monkeypatch):
+    calls = count_regimes(stub, monkeypatch)
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3", access_token="valid"
+    )
+
+    async def run(db):
+        await cache.clear_cache(search.user_id, db)
+        fetches = [sync.fetch_schedules(search, "DEMO") for i in range(3)]
+        assert await asyncio.gather(*fetches) == [3, 3, 3]
+        assert calls == ["bench-3"]
+        assert sync.flights == {}
+        await cache.clear_cache(search.user_id, db)
+
+    run_sync(run)
+
+
+def test_stale_while_revalidate(stub, monkeypatch):
+    calls = count_regimes(stub, monkeypatch)
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3", access_token="valid"
+    )
+
+    async def run(db):
+        await cache.clear_cache(search.user_id, db)
+        assert await sync.revalidate(search, "DEMO", None, db) == (3, "synced")
+        assert await sync.revalidate(search, "DEMO", None, db) == (0, "fresh")
+        assert len(calls) == 1
+
+        monkeypatch.setattr(config, "SCHEDULES_MAX_AGE", -1)
+        assert await sync.revalidate(search, "DEMO", None, db) == (0, "stale")
+        await db.commit()
+        assert len(sync.background) == 1
+        await asyncio.gather(*sync.background)
+        assert len(calls) == 2
+        await cache.clear_cache(search.user_id, db)
+
+    run_sync(run)
+
+
+def test_flights_run_outside_the_request(stub, monkeypatch):
+    # The request that starts a fetch only times its wait for it
+    count_regimes(stub, monkeypatch)
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3", access_token="valid"
+    )
+
+    async def run(db):
+        await cache.clear_cache(search.user_id, db)
+        await db.commit()
+        timings, timing_token = timing.start()
+        stats, stats_token = query_stats.start("GET /schedules")
+        try:
+            assert await sync.fetch_schedules(search, "DEMO") == 3
+            sync.refresh_in_background(search, "DEMO", None)
+            await asyncio.gather(*sync.background)
+        finally:
+            query_stats.stop(stats_token)
+            timing.stop(timing_token)
+        assert list(timings) == ["sync"]
+        assert stats["queries"] == 0
+        await cache.clear_cache(search.user_id, db)
+
+    run_sync(run)
+
+
+def test_sync_errors_keep_watermark(stub):
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3", access_token="invalid"
+    )
+
+    async def run(db):
+        await cache.clear_cache(search.user_id, db)
+        with pytest.raises(Exception, match="Invalid access token"):
+            await sync.sync_schedules(search, "DEMO", db)
+        assert await cache.get_sync_state(search.user_id, "bench-3", db) is None
+
+        valid = search.model_copy(update={"access_token": "valid"})
+        assert await sync.sync_schedules(valid, "DEMO", db) == 3
+        assert await cache.get_sync_state(search.user_id, "bench-3", db) is not None
+        await cache.clear_cache(search.user_id, db)
+
+    run_sync(run)
+
+
+def test_broken_parse_pool_is_replaced(stub, monkeypatch):
+    monkeypatch.setattr(config, "SFG20_PARSE_PROCESS_THRESHOLD", 1)
+    broken = sfg20.get_pool()
+    # A parse process that dies breaks the pool, as the OOM killer would
+    with pytest.raises(BrokenProcessPool):
+        broken.submit(os._exit, 1).result()
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3", access_token="valid"
+    )
+
+    async def run(db):
+        with pytest.raises(BrokenProcessPool):
+            await sync.sync_schedules(search, "DEMO", db)
+        assert sfg20.pool is None
+        assert await sync.sync_schedules(search, "DEMO", db) == 3
+        await cache.clear_cache(search.user_id, db)
+
+    try:
+        run_sync(run)
+    finally:
+        sfg20.close_pool()
+
+
+def test_api_key_eviction_during_lookup(monkeypatch):
+    async def select_config(api_key, db):
+        # config_delete commits and its NOTIFY arrives while the row is read
+        api_keys.invalidate(api_key)
+        return [{"api_key": api_key, "sfg_environment": "DEMO"}]
+
+    monkeypatch.setattr(cache, "select_config", select_config)
+    record = asyncio.run(api_keys.lookup("test_evicted_key"))
+    assert record["sfg_environment"] == "DEMO"
+    assert "test_evicted_key" not in api_keys.entries
+
+
+def test_cold_sync_releases_request_session(monkeypatch):
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3", access_token="valid"
+    )
+
+    async def run(db):
+        async def fetch_schedules(search, environment, api_key=None, progress=None):
+            assert not db.in_transaction()
+            return 3
+
+        monkeypatch.setattr(sync, "fetch_schedules", fetch_schedules)
+        await cache.clear_cache(search.user_id, db)
+        assert await sync.revalidate(search, "DEMO", None, db) == (3, "synced")
+
+    run_sync(run)
+
+
+def test_waiting_flight_reuses_result(monkeypatch):
+    monkeypatch.setattr(config, "SYNC_LOCK_POLL", 0.05)
+    search = SearchTerm(
+        user_id="test_sync_user", sharelink_id="bench-3", access_token="valid"
+    )
+    key = "test|flight|waiting"
+
+    async def run(db):
+        # Another worker is fetching the same key
+        assert (await cache.try_lock_flight(key, db))[0]
+        waiter = asyncio.create_task(sync.run_flight(search, "DEMO", None, key, None))
+        # The waiter does not hold a connection between its attempts
+        checkedout = []
+        for i in range(30):
+            await asyncio.sleep(0.01)
+            checkedout.append(cache.engine.pool.checkedout())
+        assert not waiter.done()
+        assert min(checkedout) == 1
+        await cache.set_flight(key, 7, db)
+        await db.commit()
+        assert await waiter == 7
+
+    run_sync(run)
+
+
+def test_refresher_round(stub):
+    user, link, key = "test_refresh_user", "bench-2", "test_refresh_key"
+    names = {"user": user, "link": link, "key": key}
+    setup = [
+        "INSERT INTO config (api_key, customer_name, access_token, sfg_environment) "
+        "VALUES (:key, 'Refresh test', 'valid', 'DEMO')",
+        "INSERT INTO config_shared_links (api_key, id) VALUES (:key, :link)",
+        "INSERT INTO sfg20_sync (user_id, sharelink_id, synced_at, api_key) "
+        "VALUES (:user, :link, '2000-01-01T00:00:00Z', :key)",
+    ]
+    cleanup = [
+        "DELETE FROM sfg20_sync WHERE user_id = :user",
+        "DELETE FROM sfg20_data WHERE user_id = :user",
+        "DELETE FROM config_shared_links WHERE api_key = :key",
+        "DELETE FROM config WHERE api_key = :key",
+    ]
+    locks = "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' and objid = :id"
+
+    async def execute(statements, db):
+        for statement in statements:
+            await db.execute(text(statement), names)
+        await db.commit()
+
+    async def run(db):
+        await execute(cleanup + setup, db)
+        try:
+            async with cache.session_lock(config.SCHEDULES_REFRESH_LOCK_ID):
+                # Another worker runs the round
+                assert await sync.refresh_stale_links() == 0
+            assert await sync.refresh_stale_links() == 1
+            assert (await cache.get_sync_state(user, link, db))[1] < 60
+            stmt = text(locks).bindparams(id=config.SCHEDULES_REFRESH_LOCK_ID)
+            assert (await db.execute(stmt)).scalar() == 0
+        finally:
+            await execute(cleanup, db)
+
+    run_sync(run)
+
+
+def test_finished_jobs_are_purged():
+    search = SearchTerm(
+        user_id="test_jobs_user", sharelink_id="bench-1", access_token="valid"
+    )
+    finished = (
+        "UPDATE sync_jobs SET status = 'done', "
+        "finished_at = now() - make_interval(secs => :age) WHERE id = :id"
+    )
+
+    async def run(db):
+        old = await jobs.enqueue(search, "DEMO", "test_key", db)
+        recent = await jobs.enqueue(search, "DEMO", "test_key", db)
+        age = config.JOBS_RETENTION + 60
+        await db.execute(text(finished), {"id": old["id"], "age": age})
+        await db.execute(text(finished), {"id": recent["id"], "age": 60})
+        await db.commit()
+
+        await jobs.maintain(db)
+        assert await jobs.get_job(old["id"], db) is None
+        assert (await jobs.get_job(recent["id"], db))["status"] == "done"
+        await db.execute(text("DELETE FROM sync_jobs WHERE id = :id"), recent)
+        await db.commit()
+
+    run_sync(run)
+
+
+def test_jobs_maintenance_interval(monkeypatch):
+    monkeypatch.setattr(jobs, "maintained_at", None)
+    assert jobs.maintenance_due()
+    assert not jobs.maintenance_due()
+    monkeypatch.setattr(config, "JOBS_MAINTENANCE_INTERVAL", 0)
+    assert jobs.maintenance_due()
+
+
+def test_async_schedules_job(demo_key):
+    headers = {"X-Access-Token": demo_key["key"]}
+    search = {"user_id": demo_key["user"], "sharelink_id": "bench-3"}
+    search["access_token"] = "valid"
+
+    async def work(db):
+        # One round of the job worker process
+        job = await jobs.claim(db)
+        await jobs.run_job(job)
+        return job["id"]
+
+    response = client.post(
+        "/schedules", json=search, headers=dict(headers, Prefer="respond-async")
+    )
+    assert response.status_code == 202
+    location = response.headers["Location"]
+    job_id = response.json()["data"][0]["id"]
+    assert location.endswith(f"/jobs/{job_id}")
+
+    response = client.get(location, headers=headers)
+    assert response.status_code == 202
+    assert response.json()["data"][0]["status"] == "queued"
+
+    assert run_sync(work) == job_id
+    response = client.get(location, headers=headers)
+    assert response.status_code == 200
+    job = response.json()["data"][0]
+    assert (job["status"], job["schedules"]) == ("done", 3)
+
+    response = client.get(job["link"], headers=headers)
+    assert len(response.json()["data"]) == 3
+
+
+def test_schedules_changes_since(demo_key, monkeypatch):
+    monkeypatch.setattr(sfg20_stub, "STUB_CHANGE_RATE", 0.5)
+    headers = {"X-Access-Token": demo_key["key"]}
+    search = {"user_id": demo_key["user"], "sharelink_id": "bench-10", "limit": 3}
+    search["access_token"] = "valid"
+
+    def schedules(search):
+        """IDs of the schedules of every page of a /schedules call"""
+        response = client.post("/schedules", json=search, headers=headers).json()
+        ids = [row["id"] for row in response["data"]]
+        while response.get("nextLink"):
+            response = client.get(response["nextLink"], headers=headers).json()
+            ids += [row["id"] for row in response["data"]]
+        return ids
+
+    assert len(schedules(search)) == 10
+    revision = asyncio.run(sfg20_stub.add_revision())
+    changed = [f"sch-{index}" for index in range(10) if regime.changed(index, 1, 0.5)]
+    assert len(changed) > 3
+
+    # Every page only holds the schedules changed since changes_since
+    delta = dict(search, changes_since=revision["date"])
+    assert sorted(schedules(delta)) == sorted(changed)
+    # They were merged into the cache of the whole share link
+    assert len(schedules(search)) == 10
+
+
 """
 def test_get_schedules():
     search_term = {"term": "test"}
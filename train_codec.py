@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+This script trains a zstd dictionary for the compressed fields of the cache
+(CACHE_CODEC="zstd") on a random sample of the cached entities and stores it
+in public.sfg20_codec_dicts. The API compresses the rows it writes afterwards
+with the new dictionary; rows written before keep the dictionary they were
+compressed with.
+
+    python train_codec.py --samples 5000 --size 112640
+"""
+
+import asyncio
+
+import typer
+import zstandard
+
+from libs import config
+from services import cache
+from services import codec
+
+# Instantiate the typer library
+app = typer.Typer()
+
+
+def ratio(samples, compressor):
+    size = sum([len(sample) for sample in samples])
+    compressed = sum([len(compressor.compress(sample)) for sample in samples])
+    return size / max(compressed, 1)
+
+
+async def train(type: str, samples: int, size: int, dry_run: bool):
+    async with cache.session_scope() as db:
+        data = await cache.sample_payloads(type, samples, db)
+        print(f"Sampled {len(data)} {type}")
+
+        dictionary = zstandard.train_dictionary(size, data)
+        level = config.CACHE_CODEC_LEVEL
+        plain = ratio(data, zstandard.ZstdCompressor(level=level))
+        trained = ratio(
+            data, zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        )
+        print(f"Compression ratio at level {level}: {plain:.2f} without dictionary")
+        print(f"Compression ratio at level {level}: {trained:.2f} with dictionary")
+
+        if not dry_run:
+            dict_id = await cache.add_dictionary(dictionary.as_bytes(), len(data), db)
+            print(f"Stored dictionary {dict_id} ({len(dictionary.as_bytes())} bytes)")
+
+
+# define the function for the command line
+@app.command()
+def main(
+    type: str = "tasks",
+    samples: int = 5000,
+    size: int = 112640,
+    dry_run: bool = False,
+):
+    if type not in config.CACHE_CODEC_FIELDS:
+        raise typer.BadParameter(f"No CACHE_CODEC_FIELDS for {type}")
+    if not codec.enabled():
+        print('CACHE_CODEC is not "zstd": the dictionary is used once it is enabled')
+    asyncio.run(train(type, samples, size, dry_run))
+
+
+# ----------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    app()
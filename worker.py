@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+This script runs the job workers that process the asynchronous /schedules
+syncs queued in public.sync_jobs. Run as many as needed, on any node that
+reaches the cache database and SFG20:
+
+    python worker.py --concurrency 4
+"""
+
+import asyncio
+import signal
+
+import typer
+
+from services import jobs
+from services import sfg20 as sv_sfg20
+from services import sfg20_client
+
+# Instantiate the typer library
+app = typer.Typer()
+
+
+async def run(concurrency: int):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    try:
+        # A running job is finished before the worker exits
+        await asyncio.gather(*[jobs.work(stop) for i in range(concurrency)])
+    finally:
+        await sfg20_client.close_clients()
+        sv_sfg20.close_pool()
+
+
+# define the function for the command line
+@app.command()
+def main(concurrency: int = 2):
+    print(f"Processing sync jobs with {concurrency} workers")
+    asyncio.run(run(concurrency))
+
+
+# ----------------------------------------------------------------
+# Main
+# ----------------------------------------------------------------
+if __name__ == "__main__":
+    app()